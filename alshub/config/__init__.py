@@ -0,0 +1,18 @@
+import json
+from typing import Mapping
+
+
+def read_mapping_file(path: str) -> Mapping:
+    """Read a mapping from a JSON file, or from a YAML file (which needs PyYAML) if path
+    ends in .yaml or .yml. An empty file is an empty mapping."""
+    with open(path) as mapping_file:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            mapping = yaml.safe_load(mapping_file)
+        else:
+            mapping = json.load(mapping_file)
+    if mapping is None:
+        return {}
+    if not isinstance(mapping, dict):
+        raise ValueError(f"{path} must hold a mapping")
+    return mapping
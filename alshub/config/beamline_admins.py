@@ -1 +1,133 @@
+"""Beamline admins: users added to beamline groups even if ALSHub does not list them as staff
+
+The table is read from the JSON or YAML file named by BEAMLINE_ADMINS_FILE in .env, mapping
+each email to the beamlines it administers::
+
+    {"zaphod@heartofgold.org": ["bl7.3.3", "bl8.3.2"]}
+
+Emails are matched without regard to case or surrounding whitespace. The file is read once
+when the table is created. Once started, a background task checks it for changes every
+BEAMLINE_ADMINS_CHECK_INTERVAL seconds, on a worker thread, and reloads it when its
+modification time changes, so edits take effect without restarting workers and lookups
+never wait on the file. A file that cannot be read or parsed is logged and the previous
+table kept. YAML files need PyYAML.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, FrozenSet, Mapping, Optional
+
+from starlette.config import Config
+
+from alshub.config import read_mapping_file
+
+config = Config(".env")
+BEAMLINE_ADMINS_FILE = config.get("BEAMLINE_ADMINS_FILE", cast=str, default="")
+BEAMLINE_ADMINS_CHECK_INTERVAL = config.get("BEAMLINE_ADMINS_CHECK_INTERVAL", cast=float, default=5.0)
+
+# admins maintained in code, merged into whatever the file provides
 ADMINS = {}
+
+logger = logging.getLogger("users.alshub.admins")
+
+NO_BEAMLINES: FrozenSet[str] = frozenset()
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def build_index(*tables: Mapping[str, list]) -> Dict[str, FrozenSet[str]]:
+    """Merge email -> beamlines tables into one index keyed by normalized email"""
+    index: Dict[str, set] = {}
+    for table in tables:
+        for email, beamlines in table.items():
+            if isinstance(beamlines, str):
+                beamlines = [beamlines]
+            index.setdefault(normalize_email(email), set()).update(beamlines or ())
+    return {email: frozenset(beamlines) for email, beamlines in index.items()}
+
+
+class BeamlineAdmins:
+    """Index from normalized email to the beamlines a user administers, reloaded when
+    its file changes
+
+    Parameters
+    ----------
+    path : str
+        JSON or YAML file mapping emails to beamlines, or empty for only ``static``
+    static : Mapping[str, list]
+        admins that are always present, merged into the file's
+    check_interval : float
+        seconds between checks of the file's modification time, once started
+    """
+
+    def __init__(
+            self,
+            path: str = "",
+            static: Mapping[str, list] = None,
+            check_interval: float = 5.0) -> None:
+        self.path = path
+        self.static = static or {}
+        self.check_interval = check_interval
+        self._index = build_index(self.static)
+        self._mtime = None
+        self._task: Optional[asyncio.Task] = None
+        self.check()
+
+    def beamlines(self, email: str) -> FrozenSet[str]:
+        """Return the beamlines administered by email, empty if it is not an admin"""
+        if not email:
+            return NO_BEAMLINES
+        return self._index.get(normalize_email(email), NO_BEAMLINES)
+
+    def start(self):
+        """Start checking the file for changes in the background"""
+        if self.path and self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.check_interval)
+            # stat and parse off the event loop
+            await loop.run_in_executor(None, self.check)
+
+    def check(self):
+        """Reload the file if its modification time changed. Blocks on the file system."""
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self._mtime is not None:
+                logger.warning("cannot read beamline admins from %s, keeping previous table: %r", self.path, e)
+                self._mtime = None
+            return
+        if mtime == self._mtime:
+            return
+        self.reload(mtime)
+
+    def reload(self, mtime: int = None):
+        try:
+            index = build_index(read_mapping_file(self.path), self.static)
+        except Exception as e:
+            logger.error("cannot load beamline admins from %s, keeping previous table: %r", self.path, e)
+        else:
+            # swapped in one assignment, so lookups see either the old table or the new one
+            self._index = index
+            logger.info("loaded %s beamline admins from %s", len(index), self.path)
+        # not retried until the file changes again
+        self._mtime = mtime
+
+    def __len__(self):
+        return len(self._index)
+
+
+admins = BeamlineAdmins(BEAMLINE_ADMINS_FILE, ADMINS, BEAMLINE_ADMINS_CHECK_INTERVAL)
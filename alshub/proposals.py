@@ -0,0 +1,147 @@
+"""Bulk sync of proposal and ESAF membership
+
+Rather than asking ALSHub for the proposals of each user as they are looked up, a
+background task pulls the members of every proposal from ALSUserProposals at once, and
+optionally the members of every ESAF from a bulk ESAF endpoint, into local indexes. While
+an index is fresh, full lookups take the user's proposals (or ESAFs) from it and skip the
+per-user query.
+
+Both bulk endpoints are expected to answer with the members of each proposal::
+
+    {"Proposals": [{"ProposalFriendlyId": "ALS-00001", "Users": [{"LBNLID": "42"}, ...]}, ...]}
+
+or with the bare list. Entries without an id are skipped. parse_memberships is the one
+place that knows this shape. As the shape is assumed rather than documented, a payload in
+which no proposal has a member fails the sync instead of emptying the index, so lookups
+keep using the last good sync or go back to asking per user.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, Callable, Dict, FrozenSet, Iterable, List, Mapping, Optional, Set, Tuple, Union
+
+if TYPE_CHECKING:
+    from alshub.service import Upstream
+
+logger = logging.getLogger("users.alshub.proposals")
+
+
+def parse_memberships(content: Union[bytes, str]) -> Dict[str, Set[str]]:
+    """Parse a bulk membership payload into proposal id -> LBNLIDs of its members"""
+    payload = json.loads(content)
+    if isinstance(payload, dict):
+        payload = payload.get("Proposals") or []
+    memberships: Dict[str, Set[str]] = {}
+    for proposal in payload:
+        if not isinstance(proposal, dict) or not proposal.get("ProposalFriendlyId"):
+            continue
+        members = memberships.setdefault(proposal["ProposalFriendlyId"], set())
+        for user in proposal.get("Users") or ():
+            lbnlid = user.get("LBNLID") if isinstance(user, dict) else user
+            if lbnlid:
+                members.add(str(lbnlid))
+    return memberships
+
+
+class MembershipIndex:
+    """Proposals (or ESAFs) by member, and members by proposal, as of the last sync
+
+    The index only answers for ``max_age`` seconds after a sync, so that lookups go back
+    to asking ALSHub per user if syncing stops working.
+
+    Parameters
+    ----------
+    name : str
+        what the index holds, for logging
+    max_age : float
+        seconds after a sync that the index may be used
+    clock : Callable[[], float]
+        source of the current time in seconds, monotonic by default
+    """
+
+    def __init__(self, name: str, max_age: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.name = name
+        self.max_age = max_age
+        self._clock = clock
+        self._groups: Dict[str, FrozenSet[str]] = {}
+        self._members: Dict[str, FrozenSet[str]] = {}
+        self.synced: Optional[float] = None
+
+    def replace(self, memberships: Mapping[str, Iterable[str]]):
+        members = {group: frozenset(lbnlids) for group, lbnlids in memberships.items()}
+        groups: Dict[str, Set[str]] = {}
+        for group, lbnlids in members.items():
+            for lbnlid in lbnlids:
+                groups.setdefault(lbnlid, set()).add(group)
+        # swapped in together, so lookups never see half of a sync
+        self._groups, self._members = {lbnlid: frozenset(found) for lbnlid, found in groups.items()}, members
+        self.synced = self._clock()
+
+    def fresh(self) -> bool:
+        return self.synced is not None and self._clock() - self.synced < self.max_age
+
+    def groups(self, lbnlid: str) -> Optional[FrozenSet[str]]:
+        """Return the groups lbnlid is a member of, or None if the index is not fresh and
+        the upstream must be asked instead"""
+        if not self.fresh():
+            return None
+        return self._groups.get(lbnlid, frozenset())
+
+    def members(self, group: str) -> FrozenSet[str]:
+        return self._members.get(group, frozenset())
+
+    def __len__(self):
+        return len(self._members)
+
+
+async def sync_memberships(upstream: "Upstream", endpoint: str, index: MembershipIndex) -> int:
+    """Replace the contents of index with the memberships from endpoint, returning the
+    number of groups. The payload is parsed on a worker thread, as it can be large.
+    Raises ValueError, leaving index as it was, if the payload holds no memberships."""
+    response = await upstream.get(endpoint, endpoint)
+    if response.is_error:
+        raise RuntimeError(f"{endpoint} answered {response.status_code}")
+    memberships = await asyncio.get_running_loop().run_in_executor(None, parse_memberships, response.content)
+    if not any(memberships.values()):
+        # most likely a payload of another shape, which would drop every user's groups
+        raise ValueError(f"{endpoint} answered with no memberships")
+    index.replace(memberships)
+    return len(memberships)
+
+
+class MembershipSync:
+    """Runs sync_memberships for each (upstream, endpoint, index) every ``interval`` seconds
+    in the background, starting at once. A failed sync is logged and leaves its index as it
+    was, to be used until it is too old."""
+
+    def __init__(self, syncs: List[Tuple["Upstream", str, MembershipIndex]], interval: float) -> None:
+        self.syncs = syncs
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def sync(self):
+        for upstream, endpoint, index in self.syncs:
+            started = time.perf_counter()
+            try:
+                count = await sync_memberships(upstream, endpoint, index)
+            except Exception as e:
+                logger.warning("failed to sync %s from %s: %r", index.name, endpoint, e)
+            else:
+                logger.info("synced %s %s from %s in %.1fs",
+                            count, index.name, endpoint, time.perf_counter() - started)
+
+    async def run(self):
+        while True:
+            await self.sync()
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,121 @@
+"""Mapping of ALSHub beamline roles to the groups they grant
+
+ALSGetPersonRoles reports, for each beamline, the roles a user holds on it::
+
+    [{"bl7.3.3": ["Scientist", "Beamline Staff"]}, {"bl8.3.2": ["Scheduler"]}]
+
+Which roles grant which groups is a rule table, read from the JSON or YAML file named by
+ALSHUB_ROLE_RULES_FILE in .env::
+
+    {
+        "roles": {"Scientist": ["{beamline}"], "Scheduler": ["schedulers_{beamline}"]},
+        "beamlines": {"bl8.3.2": {"Scientist": [], "Beamline Staff": ["{beamline}"]}}
+    }
+
+``roles`` maps a role to group name templates, in which ``{beamline}`` is replaced by the
+beamline id. ``beamlines`` overrides the templates of some roles on some beamlines; an empty
+list means the role grants nothing there. Without a file, Scientists are granted a group
+named after the beamline.
+
+Rules are compiled once into dicts from role to precomputed (prefix, suffix) pairs, so
+mapping a payload is one dict lookup per role held.
+"""
+from functools import lru_cache
+import logging
+from typing import Dict, Iterable, List, Mapping, Sequence, Tuple
+
+from starlette.config import Config
+
+from alshub.config import read_mapping_file
+
+config = Config(".env")
+ALSHUB_ROLE_RULES_FILE = config.get("ALSHUB_ROLE_RULES_FILE", cast=str, default="")
+
+BEAMLINE = "{beamline}"
+
+logger = logging.getLogger("users.alshub.roles")
+
+# a group name template split around its beamline placeholder
+Template = Tuple[str, str]
+
+
+def compile_template(template: str) -> Template:
+    prefix, placeholder, suffix = template.partition(BEAMLINE)
+    if not placeholder:
+        # a fixed group name, granted whatever the beamline
+        return template, None
+    return prefix, suffix
+
+
+def compile_templates(templates) -> Tuple[Template, ...]:
+    if isinstance(templates, str):
+        templates = [templates]
+    return tuple(compile_template(template) for template in templates or ())
+
+
+class RoleMapper:
+    """Compiled role rules, mapping ALSHub beamline roles to group names
+
+    Parameters
+    ----------
+    roles : Mapping[str, Sequence[str]]
+        role -> group name templates, applied on every beamline
+    beamlines : Mapping[str, Mapping[str, Sequence[str]]]
+        beamline -> role -> group name templates, replacing those in ``roles`` on that beamline
+    """
+
+    def __init__(
+            self,
+            roles: Mapping[str, Sequence[str]],
+            beamlines: Mapping[str, Mapping[str, Sequence[str]]] = None) -> None:
+        self._default = self._compile(roles)
+        self._beamlines: Dict[str, Dict[str, Tuple[Template, ...]]] = {}
+        for beamline, overrides in (beamlines or {}).items():
+            self._beamlines[beamline] = self._compile({**roles, **overrides})
+
+    @staticmethod
+    def _compile(roles: Mapping[str, Sequence[str]]) -> Dict[str, Tuple[Template, ...]]:
+        compiled = {role: compile_templates(templates) for role, templates in roles.items()}
+        # roles that grant nothing need not be looked at
+        return {role: templates for role, templates in compiled.items() if templates}
+
+    @classmethod
+    def from_rules(cls, rules: Mapping) -> "RoleMapper":
+        unknown = set(rules) - {"roles", "beamlines"}
+        if unknown:
+            raise ValueError(f"unknown role rule sections: {', '.join(sorted(unknown))}")
+        return cls(rules.get("roles") or {}, rules.get("beamlines"))
+
+    def groups(self, beamline_roles: Iterable[Mapping[str, Sequence[str]]]) -> List[str]:
+        """Return the groups granted by an ALSHub ``Beamline Roles`` list, in the order
+        first granted and without repeats. Every beamline of each entry is looked at."""
+        groups = {}
+        default = self._default
+        overrides = self._beamlines
+        for entry in beamline_roles or ():
+            for beamline, roles in entry.items():
+                rules = overrides.get(beamline, default) if overrides else default
+                if not roles or not rules:
+                    continue
+                for role in roles:
+                    templates = rules.get(role)
+                    if templates is None:
+                        continue
+                    for prefix, suffix in templates:
+                        groups[prefix if suffix is None else prefix + beamline + suffix] = None
+        return list(groups)
+
+
+def load_role_mapper(path: str, approval_roles: Sequence[str]) -> RoleMapper:
+    """Compile the rules in path, or if there is none, rules granting each approval role
+    a group named after the beamline"""
+    if not path:
+        return approval_role_mapper(tuple(approval_roles))
+    mapper = RoleMapper.from_rules(read_mapping_file(path))
+    logger.info("loaded beamline role rules from %s", path)
+    return mapper
+
+
+@lru_cache(maxsize=32)
+def approval_role_mapper(approval_roles: Tuple[str, ...]) -> RoleMapper:
+    return RoleMapper({role: [BEAMLINE] for role in approval_roles})
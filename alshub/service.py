@@ -1,14 +1,33 @@
 
+import asyncio
 from enum import Enum
 import logging
 import ssl
-from typing import List
-from httpx import AsyncClient
+import time
+from typing import Dict, List, Optional, Set
+from httpx import AsyncClient, Limits, Response, TransportError
 from starlette.config import Config
 
-from alshub.config.beamline_admins import ADMINS
-from splash_userservice.models import User
-from splash_userservice.service import IDType, UserService, UserNotFound, CommunicationError
+from alshub.config import beamline_admins
+from alshub.proposals import MembershipIndex, MembershipSync
+from alshub.roles import ALSHUB_ROLE_RULES_FILE, approval_role_mapper, load_role_mapper
+from splash_userservice.metrics import (
+    record_circuit_state,
+    record_upstream_retry,
+    record_upstream_rejection,
+    record_upstream_status,
+    upstream_timer
+)
+from splash_userservice.models import PartialUser, User, trusted_user
+from splash_userservice.resilience import (
+    Bulkhead,
+    BulkheadFull,
+    CircuitBreaker,
+    Hedger,
+    RetryBudget,
+    backoff_delay
+)
+from splash_userservice.service import IDType, LookupDepth, UserService, UserNotFound, CommunicationError
 
 config = Config(".env")
 ALSHUB_BASE = config.get("ALSHUB_BASE", cast=str, default="https://alsusweb.lbl.gov")
@@ -23,8 +42,65 @@ ALSHUB_APPROVAL_ROLES = ["Scientist"]
 ESAF_BASE = config.get("ESAF_BASE", cast=str, default="https://als-esaf.als.lbl.gov")
 ESAF_INFO = "EsafInformation/GetESAF"
 
+# connection pool tuning, shared by every lookup made by a service instance
+UPSTREAM_TIMEOUT = config.get("UPSTREAM_TIMEOUT", cast=float, default=10.0)
+UPSTREAM_MAX_CONNECTIONS = config.get("UPSTREAM_MAX_CONNECTIONS", cast=int, default=100)
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = config.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", cast=int, default=20)
+UPSTREAM_KEEPALIVE_EXPIRY = config.get("UPSTREAM_KEEPALIVE_EXPIRY", cast=float, default=30.0)
+# bound on each of the concurrent staff role, proposal and esaf queries
+UPSTREAM_LEG_TIMEOUT = config.get("UPSTREAM_LEG_TIMEOUT", cast=float, default=5.0)
+# requires the h2 package (pip install httpx[http2])
+UPSTREAM_HTTP2 = config.get("UPSTREAM_HTTP2", cast=bool, default=False)
+
+# circuit breaker per upstream: consecutive failures that open it, and seconds it stays open
+UPSTREAM_BREAKER_FAILURES = config.get("UPSTREAM_BREAKER_FAILURES", cast=int, default=5)
+UPSTREAM_BREAKER_RECOVERY_TIME = config.get("UPSTREAM_BREAKER_RECOVERY_TIME", cast=float, default=30.0)
+# calls in flight at least this many seconds count as circuit breaker failures, whether they
+# then answer or are abandoned, so keep it below UPSTREAM_LEG_TIMEOUT
+UPSTREAM_SLOW_CALL_TIME = config.get("UPSTREAM_SLOW_CALL_TIME", cast=float, default=4.0)
+# bulkhead per upstream: most requests in flight, and seconds to wait for a free slot
+ALSHUB_MAX_CONCURRENCY = config.get("ALSHUB_MAX_CONCURRENCY", cast=int, default=60)
+ESAF_MAX_CONCURRENCY = config.get("ESAF_MAX_CONCURRENCY", cast=int, default=20)
+UPSTREAM_BULKHEAD_WAIT = config.get("UPSTREAM_BULKHEAD_WAIT", cast=float, default=0.5)
+# retries of connection errors and 502/503/504, with jittered exponential backoff between them
+UPSTREAM_RETRIES = config.get("UPSTREAM_RETRIES", cast=int, default=2)
+UPSTREAM_RETRY_BACKOFF = config.get("UPSTREAM_RETRY_BACKOFF", cast=float, default=0.1)
+UPSTREAM_RETRY_BACKOFF_MAX = config.get("UPSTREAM_RETRY_BACKOFF_MAX", cast=float, default=1.0)
+# retries across all upstreams are limited to this fraction of requests, plus a trickle per second
+UPSTREAM_RETRY_BUDGET_RATIO = config.get("UPSTREAM_RETRY_BUDGET_RATIO", cast=float, default=0.1)
+UPSTREAM_RETRY_BUDGET_MIN_PER_SECOND = config.get("UPSTREAM_RETRY_BUDGET_MIN_PER_SECOND", cast=float, default=1.0)
+
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+# opt in to hedging ALSGetPerson: when it has not answered within this percentile of recent
+# latencies (and at least the min delay), send it again and use whichever answers first
+ALSHUB_HEDGE_PERSON = config.get("ALSHUB_HEDGE_PERSON", cast=bool, default=False)
+ALSHUB_HEDGE_PERCENTILE = config.get("ALSHUB_HEDGE_PERCENTILE", cast=float, default=0.95)
+ALSHUB_HEDGE_MIN_DELAY = config.get("ALSHUB_HEDGE_MIN_DELAY", cast=float, default=0.05)
+# most ALSGetPerson calls hedged, as a fraction of calls
+ALSHUB_HEDGE_MAX_RATE = config.get("ALSHUB_HEDGE_MAX_RATE", cast=float, default=0.05)
+
+# readiness probes: a cheap path on each upstream (any answer below 500 counts as up), the
+# number of requests sent at once to open pooled connections ahead of lookups, and their timeout
+ALSHUB_PROBE_PATH = config.get("ALSHUB_PROBE_PATH", cast=str, default="/")
+ESAF_PROBE_PATH = config.get("ESAF_PROBE_PATH", cast=str, default="/")
+UPSTREAM_PROBE_CONNECTIONS = config.get("UPSTREAM_PROBE_CONNECTIONS", cast=int, default=4)
+UPSTREAM_PROBE_TIMEOUT = config.get("UPSTREAM_PROBE_TIMEOUT", cast=float, default=5.0)
+
+# seconds between bulk syncs of proposal membership from ALSUserProposals, 0 to look proposals
+# up per user. A synced index is used for up to three intervals, then lookups go per user again.
+PROPOSAL_SYNC_INTERVAL = config.get("PROPOSAL_SYNC_INTERVAL", cast=float, default=0.0)
+# optional ESAF endpoint listing the members of every ESAF, synced along with proposals
+ESAF_BULK_INFO = config.get("ESAF_BULK_INFO", cast=str, default="")
+
 logger = logging.getLogger("users.alshub")
 
+# which beamline roles grant which groups, compiled once from ALSHUB_ROLE_RULES_FILE
+role_mapper = load_role_mapper(ALSHUB_ROLE_RULES_FILE, ALSHUB_APPROVAL_ROLES)
+
+# shared by both upstreams, so retries are capped against all traffic from this process
+retry_budget = RetryBudget(ratio=UPSTREAM_RETRY_BUDGET_RATIO, min_per_second=UPSTREAM_RETRY_BUDGET_MIN_PER_SECOND)
+
 context = ssl.create_default_context()
 context.load_verify_locations(cafile="./incommonrsaca.pem")
 
@@ -57,95 +133,337 @@ class ALSHubService(UserService):
     """
     is_orcid_sandbox = False
 
-    def __init__(self) -> None:
+    def __init__(
+            self,
+            alshub_client: AsyncClient = None,
+            esaf_client: AsyncClient = None,
+            hedge_person: bool = None,
+            proposal_sync_interval: float = None,
+            esaf_bulk_info: str = None) -> None:
         super().__init__()
-
-    async def get_user(self, id: str, id_type: IDType, fetch_groups=True) -> User:
+        self.alshub = Upstream("alshub", ALSHUB_BASE, alshub_client, max_concurrent=ALSHUB_MAX_CONCURRENCY)
+        self.esaf = Upstream("esaf", ESAF_BASE, esaf_client, max_concurrent=ESAF_MAX_CONCURRENCY)
+        if hedge_person is None:
+            hedge_person = ALSHUB_HEDGE_PERSON
+        self.person_hedger = Hedger(
+            ALSHUB_PERSON,
+            percentile=ALSHUB_HEDGE_PERCENTILE,
+            min_delay=ALSHUB_HEDGE_MIN_DELAY,
+            max_rate=ALSHUB_HEDGE_MAX_RATE) if hedge_person else None
+        if proposal_sync_interval is None:
+            proposal_sync_interval = PROPOSAL_SYNC_INTERVAL
+        if esaf_bulk_info is None:
+            esaf_bulk_info = ESAF_BULK_INFO
+        self.proposal_index = MembershipIndex("proposals", max_age=3 * proposal_sync_interval)
+        self.esaf_index = MembershipIndex("esafs", max_age=3 * proposal_sync_interval)
+        self.membership_sync = None
+        if proposal_sync_interval > 0:
+            syncs = [(self.alshub, ALSHUB_PROPOSAL, self.proposal_index)]
+            if esaf_bulk_info:
+                syncs.append((self.esaf, esaf_bulk_info, self.esaf_index))
+            self.membership_sync = MembershipSync(syncs, proposal_sync_interval)
+
+    async def startup(self):
+        """Open the pooled upstream clients. Connections are kept alive and reused by all lookups
+        until shutdown is called. Starts checking for changes to the beamline admins, and
+        syncing proposal membership, if enabled."""
+        self.alshub.client
+        self.esaf.client
+        beamline_admins.admins.start()
+        if self.membership_sync is not None:
+            self.membership_sync.start()
+
+    async def shutdown(self):
+        """Close the pooled upstream clients, releasing their connections"""
+        if self.membership_sync is not None:
+            await self.membership_sync.stop()
+        await beamline_admins.admins.stop()
+        await self.alshub.close()
+        await self.esaf.close()
+
+    async def probe(self) -> Dict[str, Optional[str]]:
+        """Probe ALSHub and ESAF at once, warming each connection pool"""
+        alshub, esaf = await asyncio.gather(
+            self.alshub.probe(ALSHUB_PROBE_PATH, UPSTREAM_PROBE_CONNECTIONS, UPSTREAM_PROBE_TIMEOUT),
+            self.esaf.probe(ESAF_PROBE_PATH, UPSTREAM_PROBE_CONNECTIONS, UPSTREAM_PROBE_TIMEOUT))
+        return {self.alshub.name: alshub, self.esaf.name: esaf}
+
+    @property
+    def alshub_client(self) -> AsyncClient:
+        return self.alshub.client
+
+    @property
+    def esaf_client(self) -> AsyncClient:
+        return self.esaf.client
+
+    async def get_user(self, id: str, id_type: IDType, depth: LookupDepth = LookupDepth.full) -> User:
         """Return a user object from ALSHub. Makes several calls to ALSHub to assemble user info,
         beamline membership and proposal info, which is used to populate group names.
 
         Parameters
         ----------
-        orcid : str
-            User's orcid
+        id : str
+            User's orcid or email
+        id_type : IDType
+            Type of id
+        depth : LookupDepth
+            profile only makes the person lookup, beamlines adds the staff role lookup,
+            full adds the proposal and esaf lookups, each of which is skipped while it
+            has a freshly synced index to read from
 
         Returns
         -------
         User
-            User instance populate with info from ALSHub requests
+            User instance populate with info from ALSHub requests, a PartialUser if some
+            of its groups could not be looked up
         """
 
         user_lb_id = None
         groups = set()
-        async with AsyncClient(base_url=ALSHUB_BASE, verify=context, timeout=10.0) as alsusweb_client:
-            # query for user information
-            if id_type == IDType.email:
-                q_param = "em"
+        alsusweb = self.alshub
+        # query for user information
+        if id_type == IDType.email:
+            q_param = "em"
+        else:
+            q_param = "or"
+        try:
+            url = f"{ALSHUB_PERSON}/?{q_param}={id}"
+            if self.person_hedger is not None:
+                response = await self.person_hedger.run(lambda: alsusweb.get(ALSHUB_PERSON, url))
+            else:
+                response = await alsusweb.get(ALSHUB_PERSON, url)
+        except Exception as e:
+            raise CommunicationError(f"exception talking to {ALSHUB_PERSON}/?{q_param}={id}") from e
+
+        if response.status_code == 404:
+            raise UserNotFound(f'user {id} not found in ALSHub')
+        if response.is_error:
+            logger.warning('error getting user: %s status code: %s message: %s',
+                           id,
+                           response.status_code, response.text)
+            return None
+
+        user_response_obj = response.json()
+        user_lb_id = user_response_obj.get('LBNLID')
+        if not user_lb_id:
+            raise UserNotFound(f'user {id} not found in ALSHub or could not communicate')
+        info('get_user userinfo for orcid: %s  lbid: %s',
+             id,
+             user_lb_id)
+
+        if depth == LookupDepth.profile:
+            return person_to_user(user_response_obj)
+
+        # beamline admins are added to groups even if they're not maintained in ALSHub,
+        # and whether or not ALSHub answers for their roles
+        groups.update(beamline_admins.admins.beamlines(user_response_obj.get('OrgEmail')))
+
+        # staff beamlines, proposals and esafs only depend on the person lookup above,
+        # so query them concurrently. A leg that fails or times out contributes no groups,
+        # and makes the user partial.
+        legs = [run_leg(ALSHUB_PERSON_ROLES, get_staff_beamlines(alsusweb, id))]
+        if depth == LookupDepth.full:
+            proposals = self.proposal_index.groups(user_lb_id)
+            if proposals is None:
+                legs.append(run_leg(ALSHUB_PROPOSALBY, get_user_proposals(alsusweb, user_lb_id)))
             else:
-                q_param = "or"
-            try:
-                response = await alsusweb_client.get(f"{ALSHUB_PERSON}/?{q_param}={id}")
-            except Exception as e:
-                raise CommunicationError(f"exception talking to {ALSHUB_PERSON}/?{q_param}={id}") from e
-
-            if response.status_code == 404:
-                raise UserNotFound(f'user {id} not found in ALSHub')
-            if response.is_error:
-                info('error getting user: %s status code: %s message: %s',
-                     id,
-                     response.status_code, response.json())
-                return None
-
-            user_response_obj = response.json()
-            user_lb_id = user_response_obj.get('LBNLID')
-            if not user_lb_id:
-                raise UserNotFound(f'user {id} not found in ALSHub or could not communicate')
-            info('get_user userinfo for orcid: %s  lbid: %s',
-                 id,
-                 user_lb_id)
-
-            # add staff beamlines to groups list
-            # if id_type == IDType.email:
-            beamlines = await get_staff_beamlines(alsusweb_client, id, user_response_obj['OrgEmail'])
-            if beamlines:
-                groups.update(beamlines)
-            if not fetch_groups:
-                return User(**{
-                    "uid": user_response_obj.get('LBNLID'),
-                    "given_name": user_response_obj.get('FirstName'),
-                    "family_name": user_response_obj.get('LastName'),
-                    "current_institution": user_response_obj.get('Institution'),
-                    "current_email": user_response_obj.get('OrgEmail'),
-                    "orcid": user_response_obj.get('orcid')
-                })
-            proposals = await get_user_proposals(alsusweb_client, user_lb_id)
-            if proposals:
                 groups.update(proposals)
-    
-            async with AsyncClient(base_url=ESAF_BASE, verify=context, timeout=10.0) as esaf_client:
-                esafs = await get_user_esafs(esaf_client, user_lb_id)
-                if esafs:
-                    groups.update(esafs)
-
-            return User(**{
-                "uid": user_response_obj.get('LBNLID'),
-                "given_name": user_response_obj.get('FirstName'),
-                "family_name": user_response_obj.get('LastName'),
-                "current_institution": user_response_obj.get('Institution'),
-                "current_email": user_response_obj.get('OrgEmail'),
-                "orcid": user_response_obj.get('orcid'),
-                "groups": list(groups)
-            })
-
-
-async def get_user_proposals(client, lbl_id):
-    response = await client.get(f"{ALSHUB_PROPOSALBY}/?lb={lbl_id}")
+            esafs = self.esaf_index.groups(user_lb_id)
+            if esafs is None:
+                legs.append(run_leg(ESAF_INFO, get_user_esafs(self.esaf, user_lb_id)))
+            else:
+                groups.update(esafs)
+        partial = False
+        for leg_groups in await asyncio.gather(*legs):
+            if leg_groups is None:
+                partial = True
+            else:
+                groups.update(leg_groups)
+
+        return person_to_user(user_response_obj, groups, partial=partial)
+
+
+def person_to_user(person: dict, groups: Set[str] = None, partial: bool = False) -> User:
+    """Map an ALSGetPerson response, and the groups found for the person, to a User,
+    or to a PartialUser if some of the groups could not be looked up.
+
+    Groups are sorted so that the same user encodes to the same bytes, and so the same
+    etag, in every worker.
+    """
+    return trusted_user(
+        PartialUser if partial else User,
+        uid=person.get('LBNLID'),
+        given_name=person.get('FirstName'),
+        family_name=person.get('LastName'),
+        current_institution=person.get('Institution'),
+        current_email=person.get('OrgEmail'),
+        orcid=person.get('orcid'),
+        groups=sorted(groups) if groups is not None else None)
+
+
+async def run_leg(name: str, coro, timeout: float = None):
+    """Await one leg of a user lookup, bounded by a timeout.
+
+    Returns None rather than raising if the leg fails or times out, so that
+    the remaining legs can still populate the user's groups. Legs that succeed
+    return their groups, empty if there are none.
+    """
+    if timeout is None:
+        timeout = UPSTREAM_LEG_TIMEOUT
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        info('timed out after %s seconds waiting for %s', timeout, name)
+    except CommunicationError as e:
+        info('%s unavailable, continuing without its groups: %s', name, e)
+    except Exception:
+        logger.exception('error querying %s, continuing without its groups', name)
+    return None
+
+
+class Upstream:
+    """Pooled client for one upstream host, guarded by a circuit breaker and a bulkhead
+
+    Requests that fail to connect, time out or get a 5xx count as failures towards
+    opening the circuit breaker, as do requests still in flight after ``slow_call_time``
+    seconds, whether they then answer or are abandoned by a leg timeout, and requests
+    that find the bulkhead full. A hanging upstream is as sick as one that errors. While
+    the breaker is open, and while the bulkhead has no free slot, requests raise a
+    CommunicationError without going to the upstream, so that a sick upstream fails fast
+    and cannot use up the capacity of the other.
+
+    Requests that fail to connect or get a 502, 503 or 504 are retried up to ``retries``
+    times with jittered exponential backoff, as long as the shared retry budget allows.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            base_url: str,
+            client: AsyncClient = None,
+            max_concurrent: int = 20,
+            retries: int = None,
+            budget: RetryBudget = None,
+            slow_call_time: float = None) -> None:
+        self.name = name
+        self.base_url = base_url
+        self._client = client
+        self.retries = UPSTREAM_RETRIES if retries is None else retries
+        self.budget = retry_budget if budget is None else budget
+        self.slow_call_time = UPSTREAM_SLOW_CALL_TIME if slow_call_time is None else slow_call_time
+        self.breaker = CircuitBreaker(name,
+                                      failure_threshold=UPSTREAM_BREAKER_FAILURES,
+                                      recovery_time=UPSTREAM_BREAKER_RECOVERY_TIME)
+        self.bulkhead = Bulkhead(name, max_concurrent=max_concurrent, max_wait=UPSTREAM_BULKHEAD_WAIT)
+
+    @property
+    def client(self) -> AsyncClient:
+        if self._client is None:
+            self._client = create_client(self.base_url)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get(self, endpoint: str, url: str) -> Response:
+        """GET url, retrying transient failures, recording latency and errors against endpoint"""
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                response = await self._attempt(endpoint, url)
+            except TransportError:
+                if not self._may_retry(endpoint, attempt):
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES or not self._may_retry(endpoint, attempt):
+                    return response
+            attempt += 1
+            await asyncio.sleep(backoff_delay(attempt, UPSTREAM_RETRY_BACKOFF, UPSTREAM_RETRY_BACKOFF_MAX))
+
+    async def probe(self, path: str = "/", connections: int = 1, timeout: float = 5.0) -> Optional[str]:
+        """Send ``connections`` requests for path at once, which leaves that many connections
+        open in the pool, and return None if the upstream answered them, else the error.
+        Probes bypass the circuit breaker and bulkhead, and retries, and are not counted in them."""
+        results = await asyncio.gather(
+            *[self.client.get(path, timeout=timeout) for _ in range(max(1, connections))],
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                return f"{type(result).__name__}: {result}" if str(result) else type(result).__name__
+            if result.status_code >= 500:
+                return f"status {result.status_code}"
+        return None
+
+    def _may_retry(self, endpoint: str, attempt: int) -> bool:
+        if attempt >= self.retries:
+            return False
+        if not self.budget.try_withdraw():
+            record_upstream_retry(endpoint, "budget_exhausted")
+            return False
+        record_upstream_retry(endpoint, "retried")
+        return True
+
+    async def _attempt(self, endpoint: str, url: str) -> Response:
+        try:
+            self.breaker.acquire()
+        except CommunicationError:
+            record_upstream_rejection(endpoint, "circuit_open")
+            raise
+        started = None
+        try:
+            async with self.bulkhead:
+                started = time.monotonic()
+                with upstream_timer(endpoint):
+                    response = await self.client.get(url)
+        except BulkheadFull:
+            # the bulkhead only stays full while the calls in it are slow
+            self.breaker.record_failure()
+            record_circuit_state(self.name, self.breaker.state)
+            record_upstream_rejection(endpoint, "bulkhead_full")
+            raise
+        except asyncio.CancelledError:
+            if started is not None and time.monotonic() - started >= self.slow_call_time:
+                self.breaker.record_failure()
+                record_circuit_state(self.name, self.breaker.state)
+            else:
+                self.breaker.record_cancelled()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            record_circuit_state(self.name, self.breaker.state)
+            raise
+        record_upstream_status(endpoint, response.status_code)
+        if response.status_code >= 500 or time.monotonic() - started >= self.slow_call_time:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        record_circuit_state(self.name, self.breaker.state)
+        return response
+
+
+def create_client(base_url: str) -> AsyncClient:
+    """Create a client with a keep-alive connection pool for one upstream host"""
+    limits = Limits(max_connections=UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY)
+    return AsyncClient(base_url=base_url,
+                       verify=context,
+                       timeout=UPSTREAM_TIMEOUT,
+                       limits=limits,
+                       http2=UPSTREAM_HTTP2)
+
+
+async def get_user_proposals(upstream: "Upstream", lbl_id):
+    response = await upstream.get(ALSHUB_PROPOSALBY, f"{ALSHUB_PROPOSALBY}/?lb={lbl_id}")
     if response.is_error:
-        info('error getting user proposals: %s status code: %s message: %s',
-             lbl_id,
-             response.status_code,
-             response.json())
-        return {}
+        logger.warning('error getting user proposals: %s status code: %s message: %s',
+                       lbl_id,
+                       response.status_code,
+                       response.text)
+        raise CommunicationError(f"{ALSHUB_PROPOSALBY} answered {response.status_code}")
     else:
         proposal_response_obj = response.json()
         proposals = proposal_response_obj.get('Proposals')
@@ -153,51 +471,40 @@ async def get_user_proposals(client, lbl_id):
             info('no proposals for lbnlid: %s', lbl_id)
             return []
         else:
-            info('get_user userinfo for lblid: %s proposals: %s', 
-                 lbl_id,
-                 str(proposals))
+            debug('get_user userinfo for lblid: %s proposals: %s', lbl_id, proposals)
 
             return {proposal_id for proposal_id in proposals}
 
 
-async def get_user_esafs(client, lbl_id):
-    response = await client.get(f"{ESAF_INFO}/?lb={lbl_id}")
+async def get_user_esafs(upstream: "Upstream", lbl_id):
+    response = await upstream.get(ESAF_INFO, f"{ESAF_INFO}/?lb={lbl_id}")
     if response.is_error:
-        info('error getting user esafs: %s status code: %s message: %s',
-             lbl_id,
-             response.status_code,
-             response.json())
+        logger.warning('error getting user esafs: %s status code: %s message: %s',
+                       lbl_id,
+                       response.status_code,
+                       response.text)
+        raise CommunicationError(f"{ESAF_INFO} answered {response.status_code}")
     else:
         esafs = response.json()
         if not esafs or len(esafs) == 0:
             info('no proposals for lbnlid: %s', lbl_id)
+            return set()
         else:
-            debug('get_user userinfo for lblid: %s proposals: %s', 
-                  lbl_id,
-                  str(esafs))
+            debug('get_user userinfo for lblid: %s esafs: %s', lbl_id, esafs)
 
             return {esaf["ProposalFriendlyId"] for esaf in esafs}
 
 
-async def get_staff_beamlines(ac: AsyncClient, orcid: str, email: str) -> List[str]:
-    response = await ac.get(f"{ALSHUB_PERSON_ROLES}/?or={orcid}")  
-    # ADMINS are a list maintained in a python to add users to groups even if they're not maintained in 
-    # ALSHub
-    beamlines = set()
-    if ADMINS:
-        beamlines.update(ADMINS[email])
+async def get_staff_beamlines(upstream: "Upstream", orcid: str) -> List[str]:
+    response = await upstream.get(ALSHUB_PERSON_ROLES, f"{ALSHUB_PERSON_ROLES}/?or={orcid}")
     if response.is_error:
-        info(f"error asking ALHub for staff roles {orcid}")
-        return beamlines
+        logger.warning("error asking ALSHub for staff roles %s", orcid)
+        raise CommunicationError(f"{ALSHUB_PERSON_ROLES} answered {response.status_code}")
     if response.content:
-        alshub_beamlines = alshub_roles_to_beamline_groups(
-                            response.json()["Beamline Roles"],
-                            ALSHUB_APPROVAL_ROLES)
-        beamlines |= set(alshub_beamlines)
-        return beamlines
+        return role_mapper.groups(response.json()["Beamline Roles"])
     else:
-        info(f"ALSHub returned no content for roles {orcid}. So no roles found")
-        return beamlines
+        info("ALSHub returned no content for roles %s. So no roles found", orcid)
+        return []
 
 
 def alshub_roles_to_beamline_groups(beamline_roles: List, approval_roles: List) -> List[str]:
@@ -221,13 +528,6 @@ def alshub_roles_to_beamline_groups(beamline_roles: List, approval_roles: List)
                     }
                 ]
             }
-        This task here is to report beamlines where the user is a Scientist on the beamline
+        This task here is to report beamlines where the user holds one of approval_roles
     """
-    accessable_beamlines = []
-    if beamline_roles:
-        for beamline_role in beamline_roles:
-            beamline_id = list(beamline_role.keys())[0]
-            for approval_role in approval_roles:
-                if approval_role in beamline_role[beamline_id]:
-                    accessable_beamlines.append(list(beamline_role.keys())[0])
-    return accessable_beamlines
+    return approval_role_mapper(tuple(approval_roles)).groups(beamline_roles)
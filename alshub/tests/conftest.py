@@ -0,0 +1 @@
+from splash_userservice.tests.conftest import clock  # noqa: F401
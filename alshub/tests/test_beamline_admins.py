@@ -0,0 +1,88 @@
+import asyncio
+import json
+import os
+
+import httpx
+
+from alshub.config import beamline_admins
+from alshub.config.beamline_admins import BeamlineAdmins
+from alshub.service import ALSHUB_PERSON_ROLES, ALSHubService
+from benchmarks.fake_alshub import FakeALSHub, email, orcid
+from splash_userservice.service import IDType
+
+
+def write_admins(path, table, mtime):
+    path.write_text(json.dumps(table))
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_lookup_is_case_insensitive_and_missing_emails_are_empty(tmp_path):
+    path = tmp_path / "admins.json"
+    write_admins(path, {" Zaphod@HeartOfGold.org": ["bl7.3.3"]}, 1)
+    admins = BeamlineAdmins(str(path), static={"ford@betelgeuse.org": "bl8.3.2"})
+    assert admins.beamlines("zaphod@heartofgold.org") == {"bl7.3.3"}
+    assert admins.beamlines("FORD@betelgeuse.org") == {"bl8.3.2"}
+    assert admins.beamlines("arthur@earth.org") == set()
+    assert admins.beamlines(None) == set()
+
+
+def test_reloads_when_file_changes(tmp_path):
+    path = tmp_path / "admins.yaml"
+    path.write_text("zaphod@heartofgold.org: [bl7.3.3]\n")
+    os.utime(path, ns=(1, 1))
+    admins = BeamlineAdmins(str(path))
+    assert admins.beamlines("zaphod@heartofgold.org") == {"bl7.3.3"}
+
+    path.write_text("zaphod@heartofgold.org: [bl8.3.2]\n")
+    os.utime(path, ns=(2, 2))
+    # lookups never read the file, only checks do
+    assert admins.beamlines("zaphod@heartofgold.org") == {"bl7.3.3"}
+    admins.check()
+    assert admins.beamlines("zaphod@heartofgold.org") == {"bl8.3.2"}
+
+    # a broken file keeps the previous table
+    path.write_text("{not yaml: [")
+    os.utime(path, ns=(3, 3))
+    admins.check()
+    assert admins.beamlines("zaphod@heartofgold.org") == {"bl8.3.2"}
+
+    # as does a missing one
+    path.unlink()
+    admins.check()
+    assert admins.beamlines("zaphod@heartofgold.org") == {"bl8.3.2"}
+
+
+def test_checks_for_changes_in_the_background(tmp_path):
+    path = tmp_path / "admins.json"
+    write_admins(path, {"zaphod@heartofgold.org": ["bl7.3.3"]}, 1)
+    admins = BeamlineAdmins(str(path), check_interval=0.01)
+
+    async def run():
+        admins.start()
+        try:
+            write_admins(path, {"zaphod@heartofgold.org": ["bl8.3.2"]}, 2)
+            for _ in range(100):
+                if admins.beamlines("zaphod@heartofgold.org") == {"bl8.3.2"}:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await admins.stop()
+
+    asyncio.run(run())
+    assert admins.beamlines("zaphod@heartofgold.org") == {"bl8.3.2"}
+
+
+def test_admins_keep_their_beamlines_when_roles_fail(monkeypatch):
+    fake = FakeALSHub(users=10, error_rate={ALSHUB_PERSON_ROLES: 1.0})
+    monkeypatch.setattr(beamline_admins, "admins", BeamlineAdmins(static={email(1): ["bl7.3.3"]}))
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(app=fake, base_url="http://alshub"),
+        esaf_client=httpx.AsyncClient(app=fake, base_url="http://esaf"))
+
+    async def run():
+        try:
+            return await service.get_user(orcid(1), IDType.orcid)
+        finally:
+            await service.shutdown()
+
+    assert "bl7.3.3" in asyncio.run(run()).groups
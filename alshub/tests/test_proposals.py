@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from alshub.proposals import MembershipIndex, parse_memberships, sync_memberships
+from alshub.service import ALSHUB_PROPOSAL, ALSHUB_PROPOSALBY, ESAF_INFO, ALSHubService
+from benchmarks.fake_alshub import FakeALSHub, orcid
+from splash_userservice.service import IDType
+
+
+def test_parse_memberships():
+    payload = {"Proposals": [
+        {"ProposalFriendlyId": "ALS-1", "Users": [{"LBNLID": "42"}, {"LBNLID": 7}]},
+        {"ProposalFriendlyId": "ALS-2", "Users": ["42"]},
+        {"Users": [{"LBNLID": "1"}]},
+    ]}
+    assert parse_memberships(json.dumps(payload)) == {"ALS-1": {"42", "7"}, "ALS-2": {"42"}}
+    assert parse_memberships(json.dumps(payload["Proposals"][:1])) == {"ALS-1": {"42", "7"}}
+
+
+def test_index_only_answers_while_fresh(clock):
+    index = MembershipIndex("proposals", max_age=30, clock=clock)
+    assert index.groups("42") is None
+    index.replace({"ALS-1": ["42", "7"], "ALS-2": ["42"]})
+    assert index.groups("42") == {"ALS-1", "ALS-2"}
+    assert index.groups("1") == set()
+    assert index.members("ALS-1") == {"42", "7"}
+    index.replace({"ALS-2": ["42"]})
+    assert index.groups("7") == set()
+    clock.now = 30
+    assert index.groups("42") is None
+
+
+def test_synced_lookups_skip_per_user_membership_queries():
+    fake = FakeALSHub(users=10)
+
+    def esafs(request: httpx.Request):
+        return httpx.Response(200, json=[{"ProposalFriendlyId": "ESAF-3", "Users": [{"LBNLID": "LB3"}]}])
+
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(app=fake, base_url="http://alshub"),
+        esaf_client=httpx.AsyncClient(transport=httpx.MockTransport(esafs), base_url="http://esaf"),
+        proposal_sync_interval=60,
+        esaf_bulk_info="EsafInformation/GetAllESAFs")
+
+    async def run():
+        await service.startup()
+        try:
+            for _ in range(100):
+                if service.proposal_index.fresh() and service.esaf_index.fresh():
+                    break
+                await asyncio.sleep(0.01)
+            return [await service.get_user(orcid(number), IDType.orcid) for number in range(5)]
+        finally:
+            await service.shutdown()
+
+    users = asyncio.run(run())
+    assert "ALS-3" in users[3].groups and "ESAF-3" in users[3].groups
+    assert "ESAF-3" not in users[2].groups
+    assert fake.requests[ALSHUB_PROPOSAL] == 1
+    assert fake.requests[ALSHUB_PROPOSALBY] == 0
+    assert fake.requests[ESAF_INFO] == 0
+
+
+def test_unrecognized_payload_keeps_the_last_sync():
+    payloads = iter([
+        {"Proposals": [{"ProposalFriendlyId": "ALS-1", "Users": [{"LBNLID": "42"}]}]},
+        {"Results": [{"ProposalFriendlyId": "ALS-1", "Users": [{"LBNLID": "42"}]}]},
+        {"Proposals": []},
+    ])
+
+    def proposals(request: httpx.Request):
+        return httpx.Response(200, json=next(payloads))
+
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(transport=httpx.MockTransport(proposals), base_url="http://alshub"))
+    index = MembershipIndex("proposals", max_age=30)
+
+    async def run():
+        try:
+            assert await sync_memberships(service.alshub, ALSHUB_PROPOSAL, index) == 1
+            for _ in range(2):
+                with pytest.raises(ValueError):
+                    await sync_memberships(service.alshub, ALSHUB_PROPOSAL, index)
+        finally:
+            await service.shutdown()
+
+    asyncio.run(run())
+    assert index.groups("42") == {"ALS-1"}
@@ -0,0 +1,37 @@
+import json
+
+from alshub.roles import RoleMapper, load_role_mapper
+from alshub.service import alshub_roles_to_beamline_groups
+from benchmarks.bench_roles import run_benchmark
+
+
+def test_rules_with_templates_and_beamline_overrides():
+    mapper = RoleMapper(
+        {"Scientist": ["{beamline}"], "Scheduler": ["schedulers_{beamline}", "schedulers"]},
+        beamlines={"bl8.3.2": {"Scientist": [], "Beamline Staff": "{beamline}"}})
+    beamline_roles = [
+        {"bl7.3.3": ["Scientist", "Scheduler"], "bl8.3.2": ["Scientist", "Beamline Staff"]},
+        {"bl12.3.2": ["Scheduler", "Beamline Usage"]},
+    ]
+    assert mapper.groups(beamline_roles) == [
+        "bl7.3.3", "schedulers_bl7.3.3", "schedulers", "bl8.3.2", "schedulers_bl12.3.2"]
+    assert mapper.groups([]) == []
+    assert mapper.groups(None) == []
+
+
+def test_every_beamline_of_an_entry_is_mapped():
+    beamline_roles = [{"beamline1": ["Beamline Staff"], "beamline2": ["Scientist"]}]
+    assert alshub_roles_to_beamline_groups(beamline_roles, ["Scientist"]) == ["beamline2"]
+
+
+def test_load_rules_file(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"roles": {"Beamline Staff": ["staff_{beamline}"]}}))
+    mapper = load_role_mapper(str(path), ["Scientist"])
+    assert mapper.groups([{"bl7.3.3": ["Scientist", "Beamline Staff"]}]) == ["staff_bl7.3.3"]
+    assert load_role_mapper("", ["Scientist"]).groups([{"bl7.3.3": ["Scientist"]}]) == ["bl7.3.3"]
+
+
+def test_run_role_benchmark():
+    result = run_benchmark(payloads=10, beamlines=20, repeat=1)
+    assert set(result["us_per_payload"]) >= {"list_scan", "compiled"}
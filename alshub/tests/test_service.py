@@ -1,4 +1,30 @@
-from alshub.service import alshub_roles_to_beamline_groups
+import asyncio
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+import httpx
+
+import alshub.service
+from alshub.service import (
+    ALSHUB_PERSON,
+    ALSHUB_PERSON_ROLES,
+    ALSHUB_PROPOSALBY,
+    ESAF_INFO,
+    UPSTREAM_BREAKER_FAILURES,
+    UPSTREAM_PROBE_CONNECTIONS,
+    ALSHubService,
+    alshub_roles_to_beamline_groups,
+    person_to_user,
+    run_leg
+)
+from benchmarks.bench_users import run_benchmark
+from benchmarks.fake_alshub import FakeALSHub, Latency, orcid
+from splash_userservice import api
+from splash_userservice.cache import encode_user
+from splash_userservice.models import PYDANTIC_V1, PartialUser, User
+from splash_userservice.resilience import CircuitBreaker
+from splash_userservice.service import IDType, LookupDepth
 
 
 def test_get_beamline_roles():
@@ -31,3 +57,246 @@ def test_get_beamline_roles():
 
     beamlines = alshub_roles_to_beamline_groups([], ["Scientist"])
     assert len(beamlines) == 0
+
+
+def alshub_handler(request: httpx.Request):
+    path = request.url.path.strip("/")
+    if path == ALSHUB_PERSON:
+        return httpx.Response(200, json={
+            "LBNLID": "42",
+            "FirstName": "Ford",
+            "LastName": "Prefect",
+            "Institution": "Megadodo Publications",
+            "OrgEmail": "ford@betelgeuse.org",
+            "orcid": "0000-0002-3580-328X"})
+    if path == ALSHUB_PERSON_ROLES:
+        return httpx.Response(200, json={"Beamline Roles": [{"beamline1": ["Scientist"]}]})
+    if path == ALSHUB_PROPOSALBY:
+        return httpx.Response(200, json={"Proposals": ["ALS-0001"]})
+    if path == ESAF_INFO:
+        return httpx.Response(200, json=[{"ProposalFriendlyId": "ESAF-0001"}])
+    return httpx.Response(404)
+
+
+def test_get_user_reuses_pooled_clients():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return alshub_handler(request)
+
+    async def run():
+        service = ALSHubService(
+            alshub_client=httpx.AsyncClient(base_url="http://alshub", transport=httpx.MockTransport(handler)),
+            esaf_client=httpx.AsyncClient(base_url="http://esaf", transport=httpx.MockTransport(handler)))
+        await service.startup()
+        alshub_client = service.alshub_client
+        first = await service.get_user("0000-0002-3580-328X", IDType.orcid)
+        second = await service.get_user("0000-0002-3580-328X", IDType.orcid)
+        assert service.alshub_client is alshub_client
+        await service.shutdown()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert first.uid == "42"
+    assert sorted(first.groups) == ["ALS-0001", "ESAF-0001", "beamline1"]
+    assert not isinstance(first, PartialUser)
+    assert len(requests) == 8
+
+
+def test_run_leg_partial_results():
+    async def slow():
+        await asyncio.sleep(1)
+        return {"never"}
+
+    async def broken():
+        raise httpx.ConnectError("connection reset")
+
+    async def ok():
+        return {"beamline1"}
+
+    async def run():
+        return await asyncio.gather(
+            run_leg("slow", slow(), timeout=0.01),
+            run_leg("broken", broken()),
+            run_leg("ok", ok()))
+
+    assert asyncio.run(run()) == [None, None, {"beamline1"}]
+
+
+def test_run_benchmark_against_fake_alshub():
+    fake = FakeALSHub(users=10, error_rate={ESAF_INFO: 1.0})
+    api_key, api_keys = api.API_KEY, api.this.api_keys
+    result = asyncio.run(run_benchmark(fake, requests=20, concurrency=4, users=10))
+    assert result["status_codes"] == {"200": 20}
+    # the api is left as it was found
+    assert (api.API_KEY, api.this.api_keys) == (api_key, api_keys)
+    # cached after the first lookup of each user
+    assert result["upstream_requests"][ALSHUB_PERSON] <= 10
+    assert result["latency_ms"]["p50"] <= result["latency_ms"]["p99"]
+
+
+def test_sick_esaf_fails_fast():
+    fake = FakeALSHub(users=10, error_rate={ESAF_INFO: 1.0})
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(app=fake, base_url="http://alshub"),
+        esaf_client=httpx.AsyncClient(app=fake, base_url="http://esaf"))
+
+    async def run():
+        try:
+            for number in range(10):
+                user = await service.get_user(orcid(number), IDType.orcid)
+                assert f"ALS-{number}" in user.groups
+            return user
+        finally:
+            await service.shutdown()
+
+    user = asyncio.run(run())
+    assert isinstance(user, PartialUser)
+    assert service.esaf.breaker.state == CircuitBreaker.OPEN
+    # once the circuit opened, ESAF stopped being called
+    assert fake.requests[ESAF_INFO] == UPSTREAM_BREAKER_FAILURES
+
+
+def test_slow_esaf_fails_fast(monkeypatch):
+    monkeypatch.setattr(alshub.service, "UPSTREAM_LEG_TIMEOUT", 0.2)
+    monkeypatch.setattr(alshub.service, "UPSTREAM_SLOW_CALL_TIME", 0.1)
+    fake = FakeALSHub(users=10, latency={ESAF_INFO: Latency("fixed", 2000)})
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(app=fake, base_url="http://alshub"),
+        esaf_client=httpx.AsyncClient(app=fake, base_url="http://esaf"))
+
+    async def run():
+        try:
+            for number in range(12):
+                user = await service.get_user(orcid(number % 10), IDType.orcid)
+                assert f"ALS-{number % 10}" in user.groups
+        finally:
+            await service.shutdown()
+
+    asyncio.run(run())
+    # ESAF calls abandoned by the leg timeout count as failures, so the circuit opened
+    assert service.esaf.breaker.state == CircuitBreaker.OPEN
+    assert fake.requests[ESAF_INFO] == UPSTREAM_BREAKER_FAILURES
+
+
+def test_transient_errors_are_retried():
+    failures = {ALSHUB_PERSON: 1, ALSHUB_PROPOSALBY: 2}
+
+    def handler(request):
+        path = request.url.path.strip("/")
+        if failures.get(path):
+            failures[path] -= 1
+            return httpx.Response(503)
+        return alshub_handler(request)
+
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(base_url="http://alshub", transport=httpx.MockTransport(handler)),
+        esaf_client=httpx.AsyncClient(base_url="http://esaf", transport=httpx.MockTransport(handler)))
+
+    async def run():
+        try:
+            return await service.get_user("0000-0002-3580-328X", IDType.orcid)
+        finally:
+            await service.shutdown()
+
+    user = asyncio.run(run())
+    assert "ALS-0001" in user.groups
+
+
+def test_lookup_depth_limits_upstream_calls():
+    fake = FakeALSHub(users=10)
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(app=fake, base_url="http://alshub"),
+        esaf_client=httpx.AsyncClient(app=fake, base_url="http://esaf"))
+
+    async def run():
+        try:
+            profile = await service.get_user(orcid(1), IDType.orcid, depth=LookupDepth.profile)
+            assert profile.groups is None
+            assert sum(fake.requests.values()) == 1
+
+            beamlines = await service.get_user(orcid(1), IDType.orcid, depth=LookupDepth.beamlines)
+            assert beamlines.groups == ["bl1"]
+            assert sum(fake.requests.values()) == 3
+        finally:
+            await service.shutdown()
+
+    asyncio.run(run())
+
+
+def test_person_to_user_cpu_per_lookup():
+    """Micro-benchmark of the CPU spent turning an ALSGetPerson payload into response bytes,
+    before (validated construction, then jsonable_encoder and json.dumps as FastAPI does)
+    and after (person_to_user and encode_user), timing construction and encoding apart.
+
+    On pydantic 2 trusted_user validates as User(**fields) does, so construction costs the
+    same either way and the gain is all in encode_user. Construction is only faster on
+    pydantic 1, where validation is skipped."""
+    person = alshub_handler(httpx.Request("GET", f"http://alshub/{ALSHUB_PERSON}/")).json()
+    groups = {f"ALS-{number:04d}" for number in range(20)}
+    lookups = 2000
+
+    def construct_before():
+        return User(**{
+            "uid": person.get('LBNLID'),
+            "given_name": person.get('FirstName'),
+            "family_name": person.get('LastName'),
+            "current_institution": person.get('Institution'),
+            "current_email": person.get('OrgEmail'),
+            "orcid": person.get('orcid'),
+            "groups": list(groups)
+        })
+
+    def construct_after():
+        return person_to_user(person, groups)
+
+    def encode_before(user):
+        return json.dumps(jsonable_encoder(user), ensure_ascii=False, separators=(",", ":")).encode()
+
+    def cpu_per_lookup(fn, *args):
+        started = time.process_time()
+        for _ in range(lookups):
+            fn(*args)
+        return (time.process_time() - started) / lookups
+
+    expected = json.loads(encode_before(construct_before()))
+    expected["groups"].sort()
+    user = construct_after()
+    assert json.loads(encode_user(user)) == expected
+
+    if PYDANTIC_V1:
+        construct_before_seconds = min(cpu_per_lookup(construct_before) for _ in range(3))
+        construct_after_seconds = min(cpu_per_lookup(construct_after) for _ in range(3))
+        assert construct_after_seconds < construct_before_seconds
+    encode_before_seconds = min(cpu_per_lookup(encode_before, user) for _ in range(3))
+    encode_after_seconds = min(cpu_per_lookup(encode_user, user) for _ in range(3))
+    assert encode_after_seconds < encode_before_seconds
+
+
+def test_probe_reports_each_upstream():
+    def esaf_down(request: httpx.Request):
+        return httpx.Response(503)
+
+    probed = []
+
+    def alshub_up(request: httpx.Request):
+        probed.append(request.url.path)
+        return alshub_handler(request)
+
+    service = ALSHubService(
+        alshub_client=httpx.AsyncClient(transport=httpx.MockTransport(alshub_up), base_url="http://alshub"),
+        esaf_client=httpx.AsyncClient(transport=httpx.MockTransport(esaf_down), base_url="http://esaf"))
+
+    async def run():
+        try:
+            return await service.probe()
+        finally:
+            await service.shutdown()
+
+    results = asyncio.run(run())
+    assert results == {"alshub": None, "esaf": "status 503"}
+    assert probed == ["/"] * UPSTREAM_PROBE_CONNECTIONS
+    # probes are not held against the upstream
+    assert service.esaf.breaker.state == CircuitBreaker.CLOSED
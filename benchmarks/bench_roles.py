@@ -0,0 +1,102 @@
+"""Benchmark mapping ALSGetPersonRoles payloads to groups
+
+Builds synthetic ``Beamline Roles`` payloads and times the compiled role rules against
+the list-scanning mapping they replaced, printing per-payload times as JSON::
+
+    python -m benchmarks.bench_roles --payloads 1000 --beamlines 40 --keys-per-entry 3
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Dict, List
+
+from alshub.roles import RoleMapper
+from alshub.service import BeamlineRoles
+
+ROLES = [role.value for role in BeamlineRoles] + ["Beamline Usage", "RAC Beamline Admin"]
+
+
+def synthetic_payload(rng: random.Random, beamlines: int, keys_per_entry: int) -> List[Dict[str, List[str]]]:
+    """A Beamline Roles list covering ``beamlines`` beamlines, ``keys_per_entry`` to a dict"""
+    ids = [f"bl{number}.{rng.randrange(10)}.{rng.randrange(10)}" for number in range(beamlines)]
+    payload = []
+    for start in range(0, beamlines, keys_per_entry):
+        payload.append({
+            beamline: rng.sample(ROLES, rng.randrange(1, len(ROLES) + 1))
+            for beamline in ids[start:start + keys_per_entry]})
+    return payload
+
+
+def list_scan_groups(beamline_roles: List, approval_roles: List) -> List[str]:
+    """The mapping the rule table replaced, which only reads the first beamline of each entry"""
+    accessable_beamlines = []
+    if beamline_roles:
+        for beamline_role in beamline_roles:
+            beamline_id = list(beamline_role.keys())[0]
+            for approval_role in approval_roles:
+                if approval_role in beamline_role[beamline_id]:
+                    accessable_beamlines.append(list(beamline_role.keys())[0])
+    return accessable_beamlines
+
+
+def time_per_payload(function, payloads: List, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for payload in payloads:
+            function(payload)
+        best = min(best, time.perf_counter() - started)
+    return best / len(payloads)
+
+
+def run_benchmark(
+        payloads: int = 1000,
+        beamlines: int = 40,
+        keys_per_entry: int = 1,
+        repeat: int = 5,
+        seed: int = 0) -> Dict:
+    rng = random.Random(seed)
+    generated = [synthetic_payload(rng, beamlines, keys_per_entry) for _ in range(payloads)]
+    approval_roles = ["Scientist", "Beamline Staff"]
+    mapper = RoleMapper({role: ["{beamline}"] for role in approval_roles})
+    rules = RoleMapper({
+        "Scientist": ["{beamline}"],
+        "Beamline Staff": ["{beamline}", "staff_{beamline}"],
+        "Scheduler": ["schedulers_{beamline}"],
+    }, beamlines={"bl0.0.0": {"Scientist": []}})
+    list_scan = time_per_payload(lambda payload: list_scan_groups(payload, approval_roles), generated, repeat)
+    compiled = time_per_payload(mapper.groups, generated, repeat)
+    # every role granting a group, where scanning each role list once per rule costs the most
+    every_role = RoleMapper({role: ["{beamline}"] for role in ROLES})
+    return {
+        "payloads": payloads,
+        "beamlines": beamlines,
+        "keys_per_entry": keys_per_entry,
+        "us_per_payload": {
+            "list_scan": 1e6 * list_scan,
+            "compiled": 1e6 * compiled,
+            "compiled_with_prefixes_and_overrides": 1e6 * time_per_payload(rules.groups, generated, repeat),
+            "list_scan_every_role": 1e6 * time_per_payload(
+                lambda payload: list_scan_groups(payload, ROLES), generated, repeat),
+            "compiled_every_role": 1e6 * time_per_payload(every_role.groups, generated, repeat),
+        },
+        "speedup": list_scan / compiled if compiled else 0.0,
+    }
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark mapping beamline roles to groups")
+    parser.add_argument("--payloads", type=int, default=1000, help="synthetic payloads to map")
+    parser.add_argument("--beamlines", type=int, default=40, help="beamlines in each payload")
+    parser.add_argument("--keys-per-entry", type=int, default=1, help="beamlines in each role dict")
+    parser.add_argument("--repeat", type=int, default=5, help="runs to take the best of")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    result = run_benchmark(args.payloads, args.beamlines, args.keys_per_entry, args.repeat, args.seed)
+    sys.stdout.write(json.dumps(result, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
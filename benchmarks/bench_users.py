@@ -0,0 +1,174 @@
+"""Benchmark /api/v1/users/{id}/{id_type} against a fake ALSHub and ESAF
+
+Drives the API in-process at a fixed concurrency and prints throughput and latency
+percentiles as JSON, so that runs before and after a change can be compared::
+
+    python -m benchmarks.bench_users --requests 2000 --concurrency 32 --latency-ms 40 \\
+        --latency-dist lognormal --users 200 --output before.json
+
+Each run builds a fresh service, so caches start cold. ``--no-cache`` measures the
+ALSHub service on its own, every request going upstream.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+
+from alshub.service import ALSHubService
+from benchmarks.fake_alshub import ENDPOINTS, FakeALSHub, Latency, email, orcid
+from splash_userservice import api
+from splash_userservice.cache import CachingUserService
+
+API_KEY = "benchmark"
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+async def run_benchmark(
+        fake: FakeALSHub,
+        requests: int = 1000,
+        concurrency: int = 16,
+        users: int = 100,
+        cache: bool = True,
+        email_fraction: float = 0.0,
+        depth: str = "full",
+        seed: int = 0) -> Dict:
+    alshub = ALSHubService(
+        alshub_client=httpx.AsyncClient(app=fake, base_url="http://alshub"),
+        esaf_client=httpx.AsyncClient(app=fake, base_url="http://esaf"))
+    service = CachingUserService(alshub) if cache else alshub
+
+    rng = random.Random(seed)
+    urls = []
+    for _ in range(requests):
+        number = rng.randrange(users)
+        if rng.random() < email_fraction:
+            urls.append(f"/api/v1/users/{email(number)}/email")
+        else:
+            urls.append(f"/api/v1/users/{orcid(number)}/orcid")
+
+    latencies = []
+    statuses: Dict[int, int] = {}
+    queue = iter(urls)
+    params = {"api_key": API_KEY, "depth": depth}
+
+    async def worker(client: httpx.AsyncClient):
+        for url in queue:
+            started = time.perf_counter()
+            response = await client.get(url, params=params)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    await service.startup()
+    api.app.dependency_overrides[api.get_service] = lambda: service
+    saved_api_key, saved_api_keys = api.API_KEY, api.this.api_keys
+    api.API_KEY = API_KEY
+    api.this.api_keys = None
+    try:
+        async with httpx.AsyncClient(app=api.app, base_url="http://userservice") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+            elapsed = time.perf_counter() - started
+    finally:
+        await service.shutdown()
+        api.app.dependency_overrides.pop(api.get_service, None)
+        api.API_KEY, api.this.api_keys = saved_api_key, saved_api_keys
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "users": users,
+        "cache": cache,
+        "depth": depth,
+        "seconds": elapsed,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": 1000 * percentile(latencies, 0.50),
+            "p95": 1000 * percentile(latencies, 0.95),
+            "p99": 1000 * percentile(latencies, 0.99),
+            "max": 1000 * latencies[-1] if latencies else 0.0,
+        },
+        "status_codes": {str(code): count for code, count in sorted(statuses.items())},
+        "upstream_requests": dict(fake.requests),
+    }
+
+
+def parse_endpoint_values(values: List[str], cast) -> Dict[str, float]:
+    parsed = {}
+    for value in values or []:
+        endpoint, _, amount = value.partition("=")
+        if endpoint not in ENDPOINTS:
+            raise SystemExit(f"unknown endpoint {endpoint}, expected one of {', '.join(ENDPOINTS)}")
+        parsed[endpoint] = cast(amount)
+    return parsed
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark user lookups against a fake ALSHub")
+    parser.add_argument("--requests", type=int, default=1000, help="total requests to make")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--users", type=int, default=100, help="distinct users requested")
+    parser.add_argument("--email-fraction", type=float, default=0.0, help="fraction of lookups by email")
+    parser.add_argument("--depth", default="full", choices=["profile", "beamlines", "full"],
+                        help="how much of each user to look up")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the user cache")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="mean upstream latency")
+    parser.add_argument("--latency-dist", default="lognormal", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--endpoint-latency-ms", action="append", metavar="ENDPOINT=MS",
+                        help="mean latency for one endpoint, e.g. EsafInformation/GetESAF=200")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream 503s")
+    parser.add_argument("--endpoint-error-rate", action="append", metavar="ENDPOINT=RATE",
+                        help="error rate for one endpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to, stdout by default")
+    args = parser.parse_args(argv)
+
+    latency = {endpoint: Latency(args.latency_dist, ms)
+               for endpoint, ms in parse_endpoint_values(args.endpoint_latency_ms, float).items()}
+    fake = FakeALSHub(
+        users=args.users,
+        latency=latency,
+        default_latency=Latency(args.latency_dist, args.latency_ms, rng=random.Random(args.seed)),
+        error_rate=parse_endpoint_values(args.endpoint_error_rate, float),
+        default_error_rate=args.error_rate,
+        seed=args.seed)
+    result = asyncio.run(run_benchmark(
+        fake,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        users=args.users,
+        cache=not args.no_cache,
+        email_fraction=args.email_fraction,
+        depth=args.depth,
+        seed=args.seed))
+    result["upstream"] = {
+        "latency_ms": args.latency_ms,
+        "latency_dist": args.latency_dist,
+        "endpoint_latency_ms": args.endpoint_latency_ms or [],
+        "error_rate": args.error_rate,
+        "endpoint_error_rate": args.endpoint_error_rate or [],
+    }
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Stand-in for the ALSHub and ESAF web services, for benchmarks and tests
+
+Implements ALSGetPerson, ALSGetProposalsBy, ALSGetPersonRoles, ALSUserProposals and
+EsafInformation/GetESAF for a set of generated users, with configurable latency
+and error rate per endpoint. It is an ASGI app, so it can be served in-process
+through an httpx client::
+
+    AsyncClient(app=FakeALSHub(), base_url="http://alshub")
+
+or on its own port, with uvicorn installed::
+
+    python -m benchmarks.fake_alshub --port 9100 --latency-ms 50
+"""
+import argparse
+import asyncio
+import math
+import random
+from typing import Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from alshub.service import ALSHUB_PERSON, ALSHUB_PERSON_ROLES, ALSHUB_PROPOSAL, ALSHUB_PROPOSALBY, ESAF_INFO
+
+ENDPOINTS = (ALSHUB_PERSON, ALSHUB_PROPOSALBY, ALSHUB_PERSON_ROLES, ALSHUB_PROPOSAL, ESAF_INFO)
+
+
+class Latency:
+    """Distribution of response delays, in milliseconds
+
+    Parameters
+    ----------
+    distribution : str
+        "fixed", "uniform" (between 0 and twice the mean) or "lognormal" (long tailed)
+    mean_ms : float
+        mean delay in milliseconds
+    sigma : float
+        shape of the lognormal distribution, larger has a longer tail
+    """
+
+    def __init__(self, distribution: str = "fixed", mean_ms: float = 0.0, sigma: float = 1.0,
+                 rng: random.Random = None) -> None:
+        if distribution not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"unknown latency distribution {distribution}")
+        self.distribution = distribution
+        self.mean_ms = mean_ms
+        self.sigma = sigma
+        self._rng = rng or random.Random()
+
+    def sample(self) -> float:
+        """seconds to delay the next response by"""
+        if self.mean_ms <= 0:
+            return 0.0
+        if self.distribution == "uniform":
+            ms = self._rng.uniform(0, 2 * self.mean_ms)
+        elif self.distribution == "lognormal":
+            # choose mu so that the distribution has the requested mean
+            mu = math.log(self.mean_ms) - self.sigma ** 2 / 2
+            ms = self._rng.lognormvariate(mu, self.sigma)
+        else:
+            ms = self.mean_ms
+        return ms / 1000.0
+
+
+class FakeALSHub:
+    """ASGI app answering ALSHub and ESAF requests for ``users`` generated users
+
+    User ``n`` has ORCID ``0000-0000-0000-nnnn`` and email ``usern@example.com``, is
+    a Scientist on beamline ``bl(n % 10)``, and is on proposal ``ALS-n`` and ESAF ``ESAF-n``.
+    Unknown users get a 404 from ALSGetPerson.
+
+    Parameters
+    ----------
+    users : int
+        number of users known to the fake
+    latency : Dict[str, Latency]
+        delay per endpoint, endpoints missing from the dict use ``default_latency``
+    error_rate : Dict[str, float]
+        fraction of requests per endpoint answered with a 503
+    """
+
+    def __init__(
+            self,
+            users: int = 1000,
+            latency: Dict[str, Latency] = None,
+            default_latency: Latency = None,
+            error_rate: Dict[str, float] = None,
+            default_error_rate: float = 0.0,
+            seed: Optional[int] = None) -> None:
+        self.users = users
+        self.latency = latency or {}
+        self.default_latency = default_latency or Latency()
+        self.error_rate = error_rate or {}
+        self.default_error_rate = default_error_rate
+        self.requests = {endpoint: 0 for endpoint in ENDPOINTS}
+        self._rng = random.Random(seed)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        request = Request(scope, receive)
+        endpoint = request.url.path.strip("/")
+        response = await self.respond(endpoint, request.query_params)
+        await response(scope, receive, send)
+
+    async def respond(self, endpoint: str, params) -> JSONResponse:
+        if endpoint not in self.requests:
+            return JSONResponse({"error": "not found"}, status_code=404)
+        self.requests[endpoint] += 1
+        delay = self.latency.get(endpoint, self.default_latency).sample()
+        if delay:
+            await asyncio.sleep(delay)
+        if self._rng.random() < self.error_rate.get(endpoint, self.default_error_rate):
+            return JSONResponse({"error": "service unavailable"}, status_code=503)
+
+        if endpoint == ALSHUB_PERSON:
+            number = self.user_number(params)
+            if number is None:
+                return JSONResponse({"error": "user not found"}, status_code=404)
+            return JSONResponse(self.person(number))
+        if endpoint == ALSHUB_PROPOSAL:
+            return JSONResponse({"Proposals": [
+                {"ProposalFriendlyId": f"ALS-{number}", "Users": [{"LBNLID": f"LB{number}"}]}
+                for number in range(self.users)]})
+        number = self.user_number(params)
+        if endpoint == ALSHUB_PERSON_ROLES:
+            roles = [{f"bl{number % 10}": ["Scientist", "Beamline Staff"]}] if number is not None else []
+            return JSONResponse({"Beamline Roles": roles})
+        if endpoint == ALSHUB_PROPOSALBY:
+            return JSONResponse({"Proposals": [f"ALS-{number}"] if number is not None else []})
+        return JSONResponse([{"ProposalFriendlyId": f"ESAF-{number}"}] if number is not None else [])
+
+    def user_number(self, params) -> Optional[int]:
+        if "or" in params:
+            prefix, number = params["or"][:15], params["or"][15:]
+            ok = prefix == "0000-0000-0000-"
+        elif "em" in params:
+            number = params["em"][len("user"):-len("@example.com")]
+            ok = params["em"].startswith("user") and params["em"].endswith("@example.com")
+        elif "lb" in params:
+            number = params["lb"][len("LB"):]
+            ok = params["lb"].startswith("LB")
+        else:
+            return None
+        if not ok or not number.isdigit() or int(number) >= self.users:
+            return None
+        return int(number)
+
+    @staticmethod
+    def person(number: int) -> dict:
+        return {
+            "LBNLID": f"LB{number}",
+            "FirstName": "User",
+            "LastName": str(number),
+            "Institution": "Example Lab",
+            "OrgEmail": email(number),
+            "orcid": orcid(number)
+        }
+
+
+def orcid(number: int) -> str:
+    return f"0000-0000-0000-{number:04d}"
+
+
+def email(number: int) -> str:
+    return f"user{number}@example.com"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake ALSHub and ESAF")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--latency-dist", default="fixed", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    import uvicorn
+    app = FakeALSHub(users=args.users,
+                     default_latency=Latency(args.latency_dist, args.latency_ms),
+                     default_error_rate=args.error_rate)
+    uvicorn.run(app, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""Gunicorn settings for the user service
+
+The defaults of the tiangolo/uvicorn-gunicorn-fastapi image, which size the workers from
+the environment, plus a child_exit hook that drops the metrics of workers that exit, so
+that in-flight gauges only count live workers when PROMETHEUS_MULTIPROC_DIR is set.
+Used by the Docker image through GUNICORN_CONF; elsewhere run::
+
+    gunicorn -c gunicorn_conf.py -k uvicorn.workers.UvicornWorker splash_userservice.api:app
+"""
+import os
+
+IMAGE_CONF = "/gunicorn_conf.py"
+
+if os.path.exists(IMAGE_CONF) and os.path.abspath(__file__) != IMAGE_CONF:
+    with open(IMAGE_CONF) as image_conf:
+        exec(image_conf.read())
+
+
+def child_exit(server, worker):
+    from splash_userservice.metrics import mark_worker_dead
+    mark_worker_dead(worker.pid)
@@ -42,10 +42,11 @@ setup(
     author_email='dmcreynolds@lbl.gov',
     url='https://github.com/dylanmcreynolds/userworld',
     python_requires='>={}'.format('.'.join(str(n) for n in min_version)),
-    packages=find_packages(exclude=['docs', 'tests']),
+    packages=find_packages(exclude=['docs', 'tests', 'benchmarks']),
     entry_points={
         'console_scripts': [
             # 'alshub = uvicorn alshub.api:app',
+            'splash_userservice_warmup = splash_userservice.warmup:main',
         ],
     },
     include_package_data=True,
@@ -1,25 +1,85 @@
 
+import asyncio
+import json
 import logging
+import math
+import os
 import sys
-from typing import List
+import tempfile
+import time
+from typing import List, Optional
 
-from fastapi import Depends, FastAPI, Security
+from fastapi import Body, Depends, FastAPI, Query, Request, Security
 from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security.api_key import APIKeyQuery, APIKeyCookie, APIKeyHeader, APIKey
 from pydantic import BaseModel, Field
 from starlette.config import Config
-from starlette.status import HTTP_403_FORBIDDEN
+from starlette.datastructures import CommaSeparatedStrings
+from starlette.status import (
+    HTTP_304_NOT_MODIFIED,
+    HTTP_403_FORBIDDEN,
+    HTTP_429_TOO_MANY_REQUESTS,
+    HTTP_503_SERVICE_UNAVAILABLE
+)
+from splash_userservice.cache import CacheEntry, CachingUserService
+from splash_userservice.clients import ApiClient, ApiKeys, FairShareUserService, current_client
+from splash_userservice import metrics
+from splash_userservice.groups import GroupIndex
+from splash_userservice.logs import parse_sample_rates, setup_logging
 from splash_userservice.models import (
+    AccessGroup,
     User,
     UniqueId
 )
-from splash_userservice.service import CommunicationError, IDType, UserService, UserNotFound
+from splash_userservice.readiness import UpstreamProbe
+from splash_userservice.service import CommunicationError, IDType, LookupDepth, UserService, UserNotFound
+from splash_userservice.store import SQLiteUserStore
+from splash_userservice.warmup import warm_up_from_file
 
 
 API_KEY_NAME = "api_key"
 QUERY_USERs_API = 'query_users'
 config = Config(".env")
 API_KEY = config("API_KEY", cast=str, default="")
+# JSON file of named clients, each with its own key, rate limit and weight, see splash_userservice.clients.
+# Rate limits are per worker process, as is FAIR_SHARE_CONCURRENCY
+API_KEYS_FILE = config("API_KEYS_FILE", cast=str, default="")
+# most upstream lookups in flight at once in each worker, shared between clients by weight, 0 for no limit
+FAIR_SHARE_CONCURRENCY = config("FAIR_SHARE_CONCURRENCY", cast=int, default=32)
+USER_CACHE_TTL = config("USER_CACHE_TTL", cast=float, default=300.0)
+USER_CACHE_MAX_SIZE = config("USER_CACHE_MAX_SIZE", cast=int, default=10000)
+USER_CACHE_NOT_FOUND_TTL = config("USER_CACHE_NOT_FOUND_TTL", cast=float, default=30.0)
+USER_CACHE_STALE_GRACE = config("USER_CACHE_STALE_GRACE", cast=float, default=300.0)
+# sqlite database shared by all workers on the node, empty to disable
+USER_CACHE_SHARED_PATH = config(
+    "USER_CACHE_SHARED_PATH",
+    cast=str,
+    default=os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                         "splash_userservice_cache.sqlite"))
+# sqlite database on disk keeping users across restarts, empty to disable, and the seconds
+# after a user was looked up that it may still be served from there while it is refreshed.
+# Longer than USER_CACHE_TTL + USER_CACHE_STALE_GRACE on purpose, so that a restart serves
+# users from disk rather than waiting for the upstreams
+USER_CACHE_PERSIST_PATH = config("USER_CACHE_PERSIST_PATH", cast=str, default="")
+USER_CACHE_PERSIST_MAX_AGE = config("USER_CACHE_PERSIST_MAX_AGE", cast=float, default=86400.0)
+# number of users resolved at once by a single batch request, and most users in one batch
+BATCH_CONCURRENCY = config("BATCH_CONCURRENCY", cast=int, default=16)
+BATCH_MAX_SIZE = config("BATCH_MAX_SIZE", cast=int, default=10000)
+# optional file of ORCIDs and emails to resolve at startup, before reporting ready
+WARMUP_SEED_FILE = config("WARMUP_SEED_FILE", cast=str, default="")
+WARMUP_RATE = config("WARMUP_RATE", cast=float, default=10.0)
+WARMUP_CONCURRENCY = config("WARMUP_CONCURRENCY", cast=int, default=4)
+# seconds between background probes of ALSHub and ESAF, whose last results /readyz reports
+READY_PROBE_INTERVAL = config("READY_PROBE_INTERVAL", cast=float, default=15.0)
+# upstreams that must have answered a probe before the worker is ready, separated by commas,
+# the others are reported but don't hold readiness back, as lookups work without them
+READY_REQUIRED_UPSTREAMS = config("READY_REQUIRED_UPSTREAMS", cast=CommaSeparatedStrings, default="alshub")
+# logging of the users loggers: level, "json" or "text" records, and the fraction of records below
+# WARNING kept from high-volume loggers, as logger=fraction pairs
+LOG_LEVEL = config("LOG_LEVEL", cast=str, default="INFO")
+LOG_FORMAT = config("LOG_FORMAT", cast=str, default="json")
+LOG_SAMPLE_RATES = config("LOG_SAMPLE_RATES", cast=parse_sample_rates, default="users.api=0.1,users.alshub=0.1")
 
 api_key_query = APIKeyQuery(name=API_KEY_NAME, auto_error=False)
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
@@ -54,64 +114,330 @@ class GetUsersGroupsResponse(BaseModel):
     groups: List[GroupSummary] = Field(description="list of group IDs and names")
 
 
-logger = logging.getLogger("users")
+class GetGroupMembersResponse(BaseModel):
+    group: AccessGroup = Field(description="group, with the page of members requested")
+    total: int = Field(description="number of known members of the group")
+    offset: int = Field(description="index of the first member returned")
+    limit: int = Field(description="maximum number of members returned")
+
+
+# Request Models
+class UserLookup(BaseModel):
+    id: str = Field(description="user's id, of type id_type")
+    id_type: IDType = Field(description="type of id")
+
+
+logger = logging.getLogger("users.api")
 app = FastAPI()
 
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        # label by route template rather than path, so ids don't each get their own series
+        route = request.scope.get("route")
+        metrics.REQUEST_LATENCY.labels(
+            request.method,
+            route.path if route is not None else "unmatched",
+            str(status)).observe(time.perf_counter() - started)
+
+
 @app.on_event("startup")
-def startup():
-    logger.setLevel(logging.DEBUG)
-    # create console handler and set level to debug
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
+async def startup():
+    # records are written by a listener thread, so logging never blocks the event loop
+    this.log_listener = setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATES)
+
+    # the one service that requests are served by, started, probed and warmed here
+    service = get_service()
+
+    # open upstream connection pools once, rather than per request
+    await service.startup()
+
+    # pre-open connections to the upstreams, and keep probing them for /readyz
+    this.probe = UpstreamProbe(service, READY_REQUIRED_UPSTREAMS, READY_PROBE_INTERVAL)
+    this.probe_task = asyncio.ensure_future(this.probe.run())
 
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # warm up in the background, so the worker is live but not ready until it's done
+    if WARMUP_SEED_FILE:
+        this.warmup = asyncio.ensure_future(warm_up_from_file(
+            service,
+            WARMUP_SEED_FILE,
+            WARMUP_RATE,
+            WARMUP_CONCURRENCY,
+            lock_file=f"{USER_CACHE_SHARED_PATH}.warmup.lock" if USER_CACHE_SHARED_PATH else None))
+        this.warmup.add_done_callback(log_warmup_failure)
 
-    # add formatter to ch
-    ch.setFormatter(formatter)
 
-    # add ch to logger
-    logger.addHandler(ch)
+def log_warmup_failure(warmup: asyncio.Future):
+    # retrieves the exception, which /readyz then reports, so it is logged here once
+    if not warmup.cancelled() and warmup.exception() is not None:
+        logger.error("warm up from %s failed: %r", WARMUP_SEED_FILE, warmup.exception())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if this.warmup is not None:
+        this.warmup.cancel()
+    if this.probe_task is not None:
+        this.probe_task.cancel()
+    if this.service is not None:
+        await this.service.shutdown()
+    if this.log_listener is not None:
+        # writes out whatever is still queued
+        this.log_listener.stop()
+        this.log_listener = None
 
 
 # do this slightly complicated thing to make dependency injection work
 # and make unit tests easier
 this = sys.modules[__name__]
-this.service = {}
+this.service = None
+this.group_index = None
+this.warmup = None
+this.api_keys = None
+this.log_listener = None
+this.probe = None
+this.probe_task = None
 
 
 def get_service() -> UserService:
-    if not this.service:
+    if this.service is None:
         from alshub.service import ALSHubService
-        this.service = ALSHubService()
+        upstream = ALSHubService()
+        if FAIR_SHARE_CONCURRENCY > 0:
+            upstream = FairShareUserService(upstream, FAIR_SHARE_CONCURRENCY)
+        this.service = CachingUserService(
+            upstream,
+            ttl=USER_CACHE_TTL,
+            max_size=USER_CACHE_MAX_SIZE,
+            not_found_ttl=USER_CACHE_NOT_FOUND_TTL,
+            stale_grace=USER_CACHE_STALE_GRACE,
+            shared=SQLiteUserStore(USER_CACHE_SHARED_PATH) if USER_CACHE_SHARED_PATH else None,
+            persistent=SQLiteUserStore(USER_CACHE_PERSIST_PATH) if USER_CACHE_PERSIST_PATH else None,
+            persist_max_age=USER_CACHE_PERSIST_MAX_AGE)
+        this.service.add_listener(get_group_index().add_user)
     return this.service
 
 
-@app.get("/api/v1/users/{id}/{id_type}")
+def get_group_index() -> GroupIndex:
+    if this.group_index is None:
+        this.group_index = GroupIndex()
+    return this.group_index
+
+
+def get_api_keys() -> ApiKeys:
+    if this.api_keys is None:
+        this.api_keys = ApiKeys.from_config(API_KEYS_FILE, API_KEY)
+    return this.api_keys
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    content_type, body = metrics.latest()
+    return Response(body, media_type=content_type)
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the worker is up and serving requests"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: every upstream in READY_REQUIRED_UPSTREAMS has answered a probe, so the
+    worker holds open connections to them, and the worker has finished warming its cache.
+    Reports the last probe results of every upstream, made in the background, so checking
+    readiness costs nothing. A failed warm up is reported, but leaves the worker ready,
+    as users are then looked up as they are asked for."""
+    body = {"status": "ready"}
+    if this.probe is not None:
+        body["upstreams"] = {name: error or "ok" for name, error in this.probe.results.items()}
+        body["checked"] = this.probe.checked
+        if not this.probe.warm:
+            body["status"] = "connecting"
+    if this.warmup is not None:
+        if not this.warmup.done():
+            if body["status"] == "ready":
+                body["status"] = "warming up"
+        elif not this.warmup.cancelled() and this.warmup.exception() is not None:
+            body["warmup"] = f"failed: {this.warmup.exception()!r}"
+    if body["status"] != "ready":
+        return JSONResponse(body, status_code=HTTP_503_SERVICE_UNAVAILABLE)
+    return body
+
+
+def lookup_depth(
+        depth: Optional[LookupDepth] = Query(
+            None, description="profile, beamlines or full (the default). Overrides fetch_groups"),
+        fetch_groups: Optional[bool] = Query(
+            None, description="deprecated, true for a full lookup and false for profile only")) -> LookupDepth:
+    if depth is not None:
+        return depth
+    if fetch_groups is not None:
+        return LookupDepth.full if fetch_groups else LookupDepth.profile
+    return LookupDepth.full
+
+
+@app.get("/api/v1/users/{id}/{id_type}", response_model=Optional[User])
 async def get_user(
         id: str,
         id_type: IDType,
-        fetch_groups: bool = False,
+        request: Request,
+        depth: LookupDepth = Depends(lookup_depth),
         user_service: UserService = Depends(get_service),
         api_key: APIKey = Depends(get_api_key_from_request)) -> User:
+    """Look up a user. Responses carry an ETag, and a request whose If-None-Match
+    holds the current ETag gets an empty 304 response."""
 
     await validate_api_key(api_key)
-    logger.info(f"Received request for {id} and {id_type}")
+    logger.info("Received request for %s and %s", id, id_type.value)
     try:
-        return await user_service.get_user(id, id_type)
+        entry = await get_user_entry(user_service, id, id_type, depth)
     except UserNotFound as e:
         raise HTTPException(404, detail=e.args[0]) from e
     except CommunicationError as e:
-        logger.error("Exception in service", e.args[0])
+        logger.error("Exception in service %s", e.args[0])
         raise HTTPException(500) from e
+    if entry.user is None:
+        return None
+
+    max_age = user_service.max_age(entry) if isinstance(user_service, CachingUserService) else 0
+    headers = {"ETag": entry.etag, "Cache-Control": f"private, max-age={max_age}"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+    # send the body encoded when the user was cached, skipping response model validation
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+async def get_user_entry(user_service: UserService, id: str, id_type: IDType, depth: LookupDepth) -> CacheEntry:
+    if isinstance(user_service, CachingUserService):
+        return await user_service.get_entry(id, id_type, depth)
+    return CacheEntry(await user_service.get_user(id, id_type, depth=depth), None, 0.0)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison, as for If-None-Match in RFC 7232
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+@app.post("/api/v1/users:batch")
+async def get_users_batch(
+        lookups: List[UserLookup] = Body(...),
+        depth: LookupDepth = Depends(lookup_depth),
+        user_service: UserService = Depends(get_service),
+        api_key: APIKey = Depends(get_api_key_from_request)) -> StreamingResponse:
+    """Resolve many users in one request. Results are streamed back as newline delimited
+    JSON in the order they complete, each line holding the id and id_type that was looked
+    up and either the "user" or an "error" with the status the single user lookup would
+    have returned."""
 
+    client = await validate_api_key(api_key)
+    if len(lookups) > BATCH_MAX_SIZE:
+        raise HTTPException(400, detail=f"at most {BATCH_MAX_SIZE} users may be requested at once")
+    logger.info("Received batch request for %s users", len(lookups))
+    return StreamingResponse(
+        stream_users(user_service, lookups, depth, client),
+        media_type="application/x-ndjson")
 
-async def validate_api_key(api_key: str):
-    if api_key != API_KEY:
+
+async def stream_users(
+        user_service: UserService,
+        lookups: List[UserLookup],
+        depth: LookupDepth,
+        client: ApiClient = None):
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def resolve(lookup: UserLookup) -> bytes:
+        result = {"id": lookup.id, "id_type": lookup.id_type.value}
+        async with semaphore:
+            if client is not None:
+                # each lookup in a batch counts against the client's rate limit, pacing the stream
+                current_client.set(client)
+                await client.bucket.acquire()
+            try:
+                entry = await get_user_entry(user_service, lookup.id, lookup.id_type, depth)
+                body = entry.body
+            except UserNotFound as e:
+                result["error"] = {"status": 404, "detail": e.args[0]}
+            except CommunicationError as e:
+                logger.error("Exception in service %s", e.args[0])
+                result["error"] = {"status": 500, "detail": "error communicating with user service"}
+            except Exception:
+                # one bad user must not end the stream for the rest of the batch
+                logger.exception("error looking up %s %s in batch", lookup.id_type.value, lookup.id)
+                result["error"] = {"status": 500, "detail": "error looking up user"}
+            else:
+                if body is not None:
+                    # splice in the cached encoding of the user rather than encoding it again
+                    return json.dumps(result)[:-1].encode() + b',"user":' + body + b'}\n'
+                result["user"] = None
+        return (json.dumps(result) + "\n").encode()
+
+    tasks = [asyncio.ensure_future(resolve(lookup)) for lookup in lookups]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # the client went away before the batch completed
+        for task in tasks:
+            task.cancel()
+
+
+@app.get("/api/v1/groups/{group}/members", response_model=GetGroupMembersResponse)
+async def get_group_members(
+        group: str,
+        offset: int = Query(0, ge=0),
+        limit: int = Query(100, ge=1, le=1000),
+        group_index: GroupIndex = Depends(get_group_index),
+        api_key: APIKey = Depends(get_api_key_from_request)) -> GetGroupMembersResponse:
+    """Members of a group (beamline, proposal or ESAF), as known from the users this
+    service has resolved."""
+
+    await validate_api_key(api_key)
+    if group not in group_index:
+        raise HTTPException(404, detail=f"no known members of group {group}")
+    return GetGroupMembersResponse(
+        group=AccessGroup(uid=group, name=group, members=group_index.members(group, offset, limit)),
+        total=group_index.count(group),
+        offset=offset,
+        limit=limit)
+
+
+async def validate_api_key(api_key: str) -> ApiClient:
+    """Return the client with this key, once it has been charged for the request, and make
+    it the current client so that its lookups get its share of upstream concurrency"""
+    client = get_api_keys().verify(api_key)
+    if client is None:
         raise HTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Could not validate credentials"
         )
+    if not client.bucket.try_acquire():
+        metrics.record_rate_limited(client.name)
+        raise HTTPException(
+            status_code=HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(math.ceil(client.bucket.retry_after()))})
+    current_client.set(client)
+    return client
 
 # @app.get("users/{id}/groups", response_model=GetUsersGroupsResponse)
 # async def get_user_groups(id: str):
@@ -0,0 +1,422 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import time
+from typing import Callable, Hashable, List, Optional, Set, Tuple
+
+from splash_userservice.metrics import CACHE_EVENTS
+from splash_userservice.models import PartialUser, User
+from splash_userservice.service import IDType, LookupDepth, UserService, UserNotFound
+from splash_userservice.singleflight import SingleFlight
+from splash_userservice.store import SQLiteUserStore
+
+logger = logging.getLogger("users.cache")
+
+HITS = CACHE_EVENTS.labels("hit")
+MISSES = CACHE_EVENTS.labels("miss")
+STALE = CACHE_EVENTS.labels("stale")
+SHARED_HITS = CACHE_EVENTS.labels("shared_hit")
+PERSISTED_HITS = CACHE_EVENTS.labels("persisted_hit")
+COALESCED = CACHE_EVENTS.labels("coalesced")
+EVICTIONS = CACHE_EVENTS.labels("eviction")
+REFRESH_FAILURES = CACHE_EVENTS.labels("refresh_failure")
+
+
+class CacheEntry:
+    """A cached lookup result: either a User, or the UserNotFound raised looking it up"""
+    __slots__ = ("user", "not_found", "expires", "_etag", "_body")
+
+    def __init__(self, user: Optional[User], not_found: Optional[UserNotFound], expires: float) -> None:
+        self.user = user
+        self.not_found = not_found
+        self.expires = expires
+        self._etag = None
+        self._body = None
+
+    @property
+    def etag(self) -> Optional[str]:
+        """Entity tag of the user, computed once per entry"""
+        if self._etag is None and self.user is not None:
+            self._etag = user_etag(self.user)
+        return self._etag
+
+    @property
+    def body(self) -> Optional[bytes]:
+        """The user encoded as a JSON response body, encoded once per entry, so that
+        hits can be sent without validating or serializing the model again"""
+        if self._body is None and self.user is not None:
+            self._body = encode_user(self.user)
+        return self._body
+
+
+class CachingUserService(UserService):
+    """UserService that caches the results of another UserService
+
+    Users are cached by (id, id_type, depth) for ``ttl`` seconds. Users that
+    could not be found are cached for ``not_found_ttl`` seconds, so that repeated
+    lookups of unknown ids do not go upstream either. At most ``max_size`` entries
+    are kept, the least recently used being evicted first.
+
+    A PartialUser, missing groups because an upstream failed, is cached for no longer
+    than ``not_found_ttl`` and only in process: it is not served stale, written to the
+    shared or persistent tiers, or passed to listeners, so one failed upstream call does
+    not take groups away from a user for long.
+
+    Concurrent misses for the same key are coalesced, so a burst of identical
+    lookups makes a single call to the wrapped service and shares its result.
+
+    With a ``stale_grace`` greater than zero, a user whose ttl has passed is still
+    returned immediately for up to ``stale_grace`` further seconds while a background
+    task refreshes it. Entries older than ``ttl + stale_grace`` are never served, unless
+    ``persist_max_age`` is set longer for the persistent tier.
+
+    An optional ``shared`` store acts as a second tier behind the in-process cache:
+    misses are looked up there before going to the wrapped service, and every lookup
+    is written to it, so that worker processes sharing a store share their lookups.
+
+    An optional ``persistent`` store, on disk, keeps users so that they survive restarts.
+    It is read for each miss that the other tiers cannot serve. A user it holds that is
+    younger than ``ttl`` is served as fresh. An older one is served at once while a
+    background task refreshes it, as for ``stale_grace``, so a restart does not have to
+    wait for every user to be looked up again. Users older than ``persist_max_age`` are
+    never served from it. By default that is ``ttl + stale_grace``, the same bound as the
+    other tiers; setting it longer is a separate choice to serve staler users after a
+    restart rather than wait for the upstream. Writes to it are not waited for.
+
+    Parameters
+    ----------
+    service : UserService
+        service to fetch users from on a cache miss
+    ttl : float
+        seconds that a found user is cached for
+    max_size : int
+        maximum number of cached entries
+    not_found_ttl : float
+        seconds that a missing user is cached for, 0 to disable negative caching
+    stale_grace : float
+        seconds past expiry that a user may be served while it is refreshed, 0 to disable
+    shared : SQLiteUserStore
+        optional second tier shared with other processes
+    persistent : SQLiteUserStore
+        optional third tier that survives restarts
+    persist_max_age : float
+        seconds after a user was resolved that the persistent tier may serve it,
+        ``ttl + stale_grace`` by default
+    clock : Callable[[], float]
+        source of the current time in seconds, monotonic by default
+    """
+
+    def __init__(
+            self,
+            service: UserService,
+            ttl: float = 300.0,
+            max_size: int = 10000,
+            not_found_ttl: float = 30.0,
+            stale_grace: float = 0.0,
+            shared: SQLiteUserStore = None,
+            persistent: SQLiteUserStore = None,
+            persist_max_age: Optional[float] = None,
+            clock: Callable[[], float] = time.monotonic,
+            wall_clock: Callable[[], float] = time.time) -> None:
+        super().__init__()
+        self.service = service
+        self.ttl = ttl
+        self.max_size = max_size
+        self.not_found_ttl = not_found_ttl
+        self.stale_grace = stale_grace
+        self.shared = shared
+        self.persistent = persistent
+        self.persist_max_age = persist_max_age if persist_max_age is not None else ttl + stale_grace
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.persisted_hits = 0
+        self.evictions = 0
+        self.stale_served = 0
+        self.refresh_failures = 0
+        self._flights = SingleFlight()
+        self._refreshes: Set[asyncio.Task] = set()
+        self._persisting: Set[asyncio.Task] = set()
+        self._listeners: List[Callable[[User, LookupDepth], None]] = []
+
+    async def startup(self):
+        if self.shared is not None:
+            await self.shared.open()
+        if self.persistent is not None:
+            await self.persistent.open()
+        await self.service.startup()
+
+    async def shutdown(self):
+        for refresh in list(self._refreshes):
+            refresh.cancel()
+        await self.service.shutdown()
+        if self.shared is not None:
+            await self.shared.close()
+        if self.persistent is not None:
+            # let queued writes finish, so lookups made just before shutdown survive it
+            await asyncio.gather(*self._persisting, return_exceptions=True)
+            await self.persistent.close()
+
+    async def probe(self):
+        return await self.service.probe()
+
+    async def get_user(self, id: str, id_type: IDType, depth: LookupDepth = LookupDepth.full) -> User:
+        return (await self.get_entry(id, id_type, depth)).user
+
+    async def get_entry(self, id: str, id_type: IDType, depth: LookupDepth = LookupDepth.full) -> CacheEntry:
+        """Like get_user, but returns the cache entry holding the user, for callers that
+        need its expiry or etag. Raises UserNotFound for cached misses."""
+        key = cache_key(id, id_type, depth)
+        entry, stale = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            HITS.inc()
+            if entry.not_found is not None:
+                raise UserNotFound(*entry.not_found.args)
+            if stale:
+                self.stale_served += 1
+                STALE.inc()
+                self._revalidate(key, id, id_type, depth)
+            return entry
+
+        self.misses += 1
+        MISSES.inc()
+        if self._flights.is_running(key):
+            COALESCED.inc()
+        entry = await self._flights.do(key, lambda: self._fetch(key, id, id_type, depth))
+        if entry.user is not None and entry.expires <= self._clock():
+            # restored from the persistent tier, older than ttl
+            self.stale_served += 1
+            STALE.inc()
+            self._revalidate(key, id, id_type, depth)
+        return entry
+
+    async def get_cached(
+            self,
+            id: str,
+            id_type: IDType,
+            depth: LookupDepth = LookupDepth.full) -> Optional[CacheEntry]:
+        """Return the fresh entry for a user held in process or in the shared tier, None if
+        it would have to be looked up upstream. Never goes upstream."""
+        key = cache_key(id, id_type, depth)
+        entry, stale = self._lookup(key)
+        if entry is not None and not stale:
+            return entry
+        if self.shared is not None:
+            return await self._fetch_shared(key)
+        return None
+
+    @property
+    def coalesced(self) -> int:
+        """number of lookups that were served by joining an identical in-flight lookup"""
+        return self._flights.coalesced
+
+    def _revalidate(self, key: Hashable, id: str, id_type: IDType, depth: LookupDepth):
+        if self._flights.is_running(key):
+            return
+        # other workers may have refreshed the user already, and the shared tier only
+        # holds fresh entries, so it is worth checking before going upstream
+        refresh = asyncio.ensure_future(
+            self._flights.do(key, lambda: self._fetch(key, id, id_type, depth, persisted=False)))
+        self._refreshes.add(refresh)
+        refresh.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, refresh: asyncio.Task):
+        self._refreshes.discard(refresh)
+        if refresh.cancelled():
+            return
+        error = refresh.exception()
+        # a refresh that finds the user gone has already cached the UserNotFound
+        if error is not None and not isinstance(error, UserNotFound):
+            self.refresh_failures += 1
+            REFRESH_FAILURES.inc()
+            logger.warning("failed to refresh stale user, serving stale until it expires: %r", error)
+
+    def max_age(self, entry: CacheEntry) -> int:
+        """Whole seconds until entry expires, 0 if it is stale"""
+        return max(0, int(entry.expires - self._clock()))
+
+    async def _fetch(
+            self,
+            key: Hashable,
+            id: str,
+            id_type: IDType,
+            depth: LookupDepth,
+            persisted: bool = True) -> CacheEntry:
+        if self.shared is not None:
+            entry = await self._fetch_shared(key)
+            if entry is not None:
+                self.shared_hits += 1
+                SHARED_HITS.inc()
+                if entry.not_found is not None:
+                    raise UserNotFound(*entry.not_found.args)
+                return entry
+        # refreshes skip the persistent tier, which would only give back the stale user
+        if persisted and self.persistent is not None:
+            entry = await self._fetch_persisted(key)
+            if entry is not None:
+                self.persisted_hits += 1
+                PERSISTED_HITS.inc()
+                return entry
+        try:
+            user = await self.service.get_user(id, id_type, depth=depth)
+        except UserNotFound as e:
+            if self.not_found_ttl > 0:
+                await self._save(key, CacheEntry(None, e, self._clock() + self.not_found_ttl))
+            raise
+        if isinstance(user, PartialUser):
+            entry = CacheEntry(user, None, self._clock() + min(self.ttl, self.not_found_ttl))
+            if self.not_found_ttl > 0:
+                self._store(key, entry)
+            return entry
+        entry = CacheEntry(user, None, self._clock() + self.ttl)
+        # services return None when the upstream errored, which should not be cached
+        if user is not None:
+            await self._save(key, entry)
+        return entry
+
+    async def _fetch_shared(self, key: Hashable) -> Optional[CacheEntry]:
+        try:
+            stored = await self.shared.get(key)
+        except Exception:
+            logger.exception("error reading shared user cache")
+            return None
+        if stored is None:
+            return None
+        user, not_found, expires, _ = stored
+        entry = CacheEntry(
+            user,
+            UserNotFound(not_found) if not_found is not None else None,
+            self._clock() + expires - self._wall_clock())
+        self._store(key, entry)
+        return entry
+
+    async def _fetch_persisted(self, key: Hashable) -> Optional[CacheEntry]:
+        try:
+            stored = await self.persistent.get(key)
+        except Exception:
+            logger.exception("error reading persistent user cache")
+            return None
+        if stored is None:
+            return None
+        user, _, _, resolved = stored
+        # written with the max age of its time, which may have been longer
+        if user is None or resolved is None or self._wall_clock() - resolved >= self.persist_max_age:
+            return None
+        # fresh for what is left of its ttl, if anything, otherwise already stale
+        entry = CacheEntry(user, None, self._clock() + resolved + self.ttl - self._wall_clock())
+        self._store(key, entry)
+        return entry
+
+    async def _save(self, key: Hashable, entry: CacheEntry):
+        self._store(key, entry)
+        if self.persistent is not None and entry.user is not None:
+            self._persist(key, entry.user)
+        if self.shared is None:
+            return
+        try:
+            await self.shared.put(
+                key,
+                entry.user,
+                entry.not_found.args[0] if entry.not_found is not None else None,
+                self._wall_clock() + entry.expires - self._clock())
+        except Exception:
+            logger.exception("error writing shared user cache")
+
+    def _persist(self, key: Hashable, user: User):
+        resolved = self._wall_clock()
+        write = asyncio.ensure_future(
+            self.persistent.put(key, user, None, resolved + self.persist_max_age, resolved=resolved))
+        self._persisting.add(write)
+        write.add_done_callback(self._persist_done)
+
+    def _persist_done(self, write: asyncio.Task):
+        self._persisting.discard(write)
+        if not write.cancelled() and write.exception() is not None:
+            logger.error("error writing persistent user cache: %r", write.exception())
+
+    def add_listener(self, listener: Callable[[User, LookupDepth], None]):
+        """Call listener with every user that is added to the cache, and the depth it was
+        looked up to, whether it came from the wrapped service, a background refresh or the
+        shared tier. Partial users are not passed on, as their groups are incomplete."""
+        self._listeners.append(listener)
+
+    def invalidate(self, id: str, id_type: IDType):
+        """Remove every cached entry for a user"""
+        for depth in LookupDepth:
+            self._entries.pop(cache_key(id, id_type, depth), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key: Hashable) -> Tuple[Optional[CacheEntry], bool]:
+        """Return the entry for key, if it can be served, and whether it is stale"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        now = self._clock()
+        if entry.expires > now:
+            stale = False
+        elif (entry.user is not None and entry.expires + self.stale_grace > now
+              and not isinstance(entry.user, PartialUser)):
+            stale = True
+        else:
+            del self._entries[key]
+            return None, False
+        self._entries.move_to_end(key)
+        return entry, stale
+
+    def _store(self, key: Hashable, entry: CacheEntry):
+        if entry.user is not None and not isinstance(entry.user, PartialUser):
+            _, _, depth = key
+            for listener in self._listeners:
+                try:
+                    listener(entry.user, depth)
+                except Exception:
+                    logger.exception("error in cache listener")
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            EVICTIONS.inc()
+
+
+def user_fields(user: User) -> dict:
+    if hasattr(user, "model_dump"):
+        return user.model_dump(mode="json")
+    return user.dict()
+
+
+def encode_user(user: User) -> bytes:
+    """Encode user as FastAPI's JSONResponse would, with pydantic's own serializer when it
+    has one, which is several times faster than json.dumps of model_dump"""
+    if hasattr(user, "model_dump_json"):
+        return user.model_dump_json().encode("utf-8")
+    return json.dumps(
+        user_fields(user),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":")).encode("utf-8")
+
+
+def user_etag(user: User) -> str:
+    """Strong entity tag for a user, the same however its groups are ordered"""
+    fields = user_fields(user)
+    if fields.get("groups") is not None:
+        fields["groups"] = sorted(fields["groups"])
+    digest = hashlib.blake2b(json.dumps(fields, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def cache_key(id: str, id_type: IDType, depth: LookupDepth) -> Tuple[str, IDType, LookupDepth]:
+    return (id, id_type, depth)
@@ -0,0 +1,156 @@
+"""API clients: their keys, rate limits and share of upstream concurrency
+
+Clients are read from the JSON file named by API_KEYS_FILE in .env, keyed by client name::
+
+    {
+        "scicat": {"key_sha256": "9f86d0...", "rate": 100, "burst": 200, "weight": 4},
+        "ingest": {"key": "...", "rate": 10, "weight": 1}
+    }
+
+Each client gives either its key or, to keep keys out of the file, the hex SHA-256 of it.
+``rate`` is the requests a second allowed on average, 0 or absent for no limit, ``burst``
+the requests allowed at once (``rate`` by default), and ``weight`` the client's share of
+upstream concurrency relative to other clients when lookups have to queue. The single
+API_KEY from .env, if set, is a client named "default" with no rate limit and weight 1.
+
+Rate limits and FAIR_SHARE_CONCURRENCY are kept by each worker process, not shared between
+them. Under gunicorn with N workers a client may make up to N times ``rate`` requests a
+second in all, and N times FAIR_SHARE_CONCURRENCY lookups can be in flight, so divide
+the node-wide limits wanted by the number of workers when writing the file.
+"""
+from contextvars import ContextVar
+import hashlib
+import json
+from typing import Dict, Mapping, Optional
+
+from splash_userservice.models import User
+from splash_userservice.resilience import FairScheduler, TokenBucket
+from splash_userservice.service import IDType, LookupDepth, UserService
+
+
+def key_digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode()).digest()
+
+
+class ApiClient:
+    """A caller of the API, identified by its key
+
+    Parameters
+    ----------
+    name : str
+        name of the client, for logs and metrics
+    digest : bytes
+        SHA-256 of the client's key
+    rate : float
+        requests a second allowed on average, 0 for no limit
+    burst : float
+        requests allowed at once, ``rate`` by default
+    weight : float
+        share of upstream concurrency, relative to other clients
+    """
+
+    def __init__(
+            self,
+            name: str,
+            digest: bytes,
+            rate: float = 0.0,
+            burst: float = None,
+            weight: float = 1.0) -> None:
+        if weight <= 0:
+            raise ValueError(f"weight of client {name} must be positive")
+        self.name = name
+        self.digest = digest
+        self.weight = weight
+        self.bucket = TokenBucket(rate, burst)
+
+    @classmethod
+    def from_config(cls, name: str, settings: Mapping) -> "ApiClient":
+        if "key_sha256" in settings:
+            digest = bytes.fromhex(settings["key_sha256"])
+        elif settings.get("key"):
+            digest = key_digest(settings["key"])
+        else:
+            raise ValueError(f"client {name} needs a key or key_sha256")
+        return cls(name, digest, settings.get("rate", 0.0), settings.get("burst"), settings.get("weight", 1.0))
+
+    def __repr__(self) -> str:
+        return f"ApiClient({self.name!r})"
+
+
+class ApiKeys:
+    """Registry of API clients by key
+
+    Keys are kept as SHA-256 digests, computed once when the registry is built. Verifying
+    a key hashes it and looks the digest up, so keys are never compared as text, and
+    a guess that shares a prefix with a stored key is no faster or slower to reject.
+    """
+
+    def __init__(self, clients=()) -> None:
+        self._clients: Dict[bytes, ApiClient] = {}
+        for client in clients:
+            self.add(client)
+
+    def add(self, client: ApiClient):
+        if client.digest in self._clients:
+            existing = self._clients[client.digest]
+            raise ValueError(f"client {client.name} has the same key as client {existing.name}")
+        self._clients[client.digest] = client
+
+    def verify(self, key: str) -> Optional[ApiClient]:
+        """Return the client with this key, None if there is none"""
+        if not key:
+            return None
+        return self._clients.get(key_digest(key))
+
+    def __len__(self):
+        return len(self._clients)
+
+    @classmethod
+    def from_config(cls, path: str = "", default_key: str = "") -> "ApiKeys":
+        keys = cls()
+        if path:
+            with open(path) as keys_file:
+                for name, settings in json.load(keys_file).items():
+                    keys.add(ApiClient.from_config(name, settings))
+        if default_key:
+            keys.add(ApiClient("default", key_digest(default_key)))
+        return keys
+
+
+# the client making the current request, set once its key has been verified
+current_client: ContextVar[Optional[ApiClient]] = ContextVar("current_client", default=None)
+
+
+class FairShareUserService(UserService):
+    """Wraps a UserService so that lookups by different clients share its concurrency
+    fairly, by client weight. Lookups made outside of any request, such as cache warm up,
+    share as one more client of weight 1. Background refreshes of stale users run in a
+    copy of the context of the request that found them stale, so they are charged to
+    that request's client.
+
+    Parameters
+    ----------
+    service : UserService
+        service to look users up from
+    max_concurrent : int
+        most lookups in flight at once, across all clients
+    """
+
+    def __init__(self, service: UserService, max_concurrent: int) -> None:
+        self.service = service
+        self.scheduler = FairScheduler(max_concurrent)
+
+    async def startup(self):
+        await self.service.startup()
+
+    async def shutdown(self):
+        await self.service.shutdown()
+
+    async def probe(self):
+        return await self.service.probe()
+
+    async def get_user(self, id: str, id_type: IDType, depth: LookupDepth = LookupDepth.full) -> User:
+        client = current_client.get()
+        name, weight = (client.name, client.weight) if client is not None else (None, 1.0)
+        async with self.scheduler.slot(name, weight):
+            return await self.service.get_user(id, id_type, depth=depth)
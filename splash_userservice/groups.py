@@ -0,0 +1,61 @@
+from itertools import islice
+from typing import Dict, FrozenSet, List
+
+from splash_userservice.models import UniqueId, User
+from splash_userservice.service import LookupDepth
+
+
+class GroupIndex:
+    """In-memory reverse index from group name to the users that are members of it
+
+    The index is built from resolved users, so it knows about every group that a
+    user looked up by this process belongs to. Adding a user again replaces their
+    memberships, removing them from groups they no longer belong to.
+    """
+
+    def __init__(self) -> None:
+        # group name -> user uid -> member id, kept in insertion order for stable paging
+        self._members: Dict[str, Dict[str, UniqueId]] = {}
+        # user uid -> the groups the user was last seen in
+        self._groups: Dict[str, FrozenSet[str]] = {}
+
+    def add_user(self, user: User, depth: LookupDepth = LookupDepth.full):
+        # users looked up without all of their groups say nothing about their membership
+        if user is None or user.groups is None or depth != LookupDepth.full:
+            return
+        self._set_groups(user.uid, frozenset(user.groups), member_id(user))
+
+    def remove_user(self, uid: str):
+        self._set_groups(uid, frozenset(), None)
+        self._groups.pop(uid, None)
+
+    def _set_groups(self, uid: str, groups: FrozenSet[str], member: UniqueId):
+        previous = self._groups.get(uid, frozenset())
+        if groups == previous:
+            return
+        for group in previous - groups:
+            members = self._members[group]
+            del members[uid]
+            if not members:
+                del self._members[group]
+        for group in groups - previous:
+            self._members.setdefault(group, {})[uid] = member
+        self._groups[uid] = groups
+
+    def members(self, group: str, offset: int = 0, limit: int = None) -> List[UniqueId]:
+        members = self._members.get(group, {}).values()
+        stop = None if limit is None else offset + limit
+        return list(islice(members, offset, stop))
+
+    def count(self, group: str) -> int:
+        return len(self._members.get(group, ()))
+
+    def __contains__(self, group: str) -> bool:
+        return group in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+
+def member_id(user: User) -> UniqueId:
+    return UniqueId(id=user.orcid, source="orcid")
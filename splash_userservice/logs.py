@@ -0,0 +1,140 @@
+"""Logging that keeps writes off the event loop
+
+Records are put on a queue by a QueueHandler on the ``users`` logger and written by a
+QueueListener thread, so a slow stdout never blocks requests. Records are written as
+one JSON object per line, or as text. High-volume loggers can be sampled: below WARNING,
+only one in every so many of their records is kept, and warnings and errors always are.
+"""
+import copy
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import sys
+from typing import Dict, Mapping, Optional, TextIO
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# attributes every LogRecord has, anything else on a record was passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(rates: str) -> Dict[str, float]:
+    """Parse sample rates given as ``logger=fraction`` pairs separated by commas,
+    e.g. ``users.api=0.1,users.alshub=0.01``"""
+    parsed = {}
+    for pair in rates.split(","):
+        if not pair.strip():
+            continue
+        name, _, rate = pair.partition("=")
+        parsed[name.strip()] = float(rate)
+    return parsed
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line of JSON, including any fields given in extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every 1/rate records below WARNING from each sampled logger
+
+    A logger is sampled at the rate of its closest configured ancestor, or itself.
+    Loggers with no configured ancestor are not sampled, and a rate of 0 drops all
+    their records below WARNING.
+    """
+
+    def __init__(self, rates: Mapping[str, float]) -> None:
+        super().__init__()
+        self.rates = dict(rates)
+        # logger name -> keep one record in this many, 0 to keep none
+        self._every: Dict[str, int] = {}
+        self._counts: Dict[str, int] = {}
+
+    def every(self, name: str) -> int:
+        every = self._every.get(name)
+        if every is None:
+            rate = 1.0
+            ancestor = name
+            while ancestor:
+                if ancestor in self.rates:
+                    rate = self.rates[ancestor]
+                    break
+                ancestor = ancestor.rpartition(".")[0]
+            every = self._every[name] = max(1, round(1 / rate)) if rate > 0 else 0
+        return every
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        every = self.every(record.name)
+        if every == 1:
+            return True
+        if every == 0:
+            return False
+        count = self._counts.get(record.name, 0)
+        self._counts[record.name] = count + 1
+        return count % every == 0
+
+
+class StructuredQueueHandler(QueueHandler):
+    """QueueHandler that keeps records structured for the formatter on the other side
+
+    The message is merged with its arguments and any traceback rendered to text here, so
+    that records can be formatted on another thread, but unlike QueueHandler's default
+    the traceback is not folded into the message.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # other handlers may still see the original
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(
+        level: str = "INFO",
+        fmt: str = "json",
+        sample_rates: Mapping[str, float] = None,
+        stream: Optional[TextIO] = None,
+        logger_name: str = "users") -> QueueListener:
+    """Send the records of logger_name and its descendants through a queue to stream, stderr
+    by default, and return the started listener. Stop it on shutdown to flush the queue.
+    Calling this again replaces the handler installed by an earlier call."""
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(level.upper())
+    for handler in list(logger.handlers):
+        if isinstance(handler, StructuredQueueHandler):
+            logger.removeHandler(handler)
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    handler = StructuredQueueHandler(records)
+    if sample_rates:
+        # dropped before they are queued, so sampled out records cost almost nothing
+        handler.addFilter(SamplingFilter(sample_rates))
+    logger.addHandler(handler)
+
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return listener
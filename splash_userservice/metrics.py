@@ -0,0 +1,142 @@
+"""Prometheus metrics for the user service
+
+When PROMETHEUS_MULTIPROC_DIR is set in the environment (it must be an empty
+directory, shared by the workers and cleared before the server starts), every
+gunicorn worker writes its metrics there and /metrics reports the sum over all
+workers. Otherwise /metrics reports the metrics of the worker that served it.
+
+In-flight and circuit breaker gauges only count live workers, which needs gunicorn to
+call mark_worker_dead from its child_exit hook, or the last values of workers that
+exited stay in /metrics. gunicorn_conf.py at the top of the repository does that, and
+the Docker image uses it.
+"""
+import asyncio
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    "userservice_request_duration_seconds",
+    "Time to respond to requests, by route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge(
+    "userservice_requests_in_flight",
+    "Requests currently being served",
+    multiprocess_mode="livesum")
+
+UPSTREAM_LATENCY = Histogram(
+    "userservice_upstream_duration_seconds",
+    "Time for ALSHub and ESAF to respond, by endpoint",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter(
+    "userservice_upstream_errors_total",
+    "Failed upstream requests, by endpoint and status code, or 'connection' if there was no response",
+    ["endpoint", "status"])
+UPSTREAM_IN_FLIGHT = Gauge(
+    "userservice_upstream_requests_in_flight",
+    "Upstream requests currently waiting for a response, by endpoint",
+    ["endpoint"],
+    multiprocess_mode="livesum")
+UPSTREAM_REJECTIONS = Counter(
+    "userservice_upstream_rejections_total",
+    "Upstream requests failed fast without being sent, by endpoint and reason: circuit_open, bulkhead_full",
+    ["endpoint", "reason"])
+UPSTREAM_RETRIES = Counter(
+    "userservice_upstream_retries_total",
+    "Retries of failed upstream requests, by endpoint and outcome: retried, budget_exhausted",
+    ["endpoint", "outcome"])
+UPSTREAM_HEDGES = Counter(
+    "userservice_upstream_hedges_total",
+    "Hedged upstream requests, by endpoint and outcome: fired, won (the hedge answered first)",
+    ["endpoint", "outcome"])
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "userservice_upstream_circuit_open",
+    "1 while the circuit breaker to an upstream is open or half open, 0 while closed",
+    ["upstream"],
+    multiprocess_mode="livemax")
+
+CACHE_EVENTS = Counter(
+    "userservice_cache_events_total",
+    "User cache lookups and maintenance, by event: "
+    "hit, miss, stale (hit served while refreshing), shared_hit, persisted_hit, coalesced, eviction, "
+    "refresh_failure",
+    ["event"])
+
+RATE_LIMITED = Counter(
+    "userservice_rate_limited_total",
+    "Requests refused because the client exceeded its rate limit, by client",
+    ["client"])
+
+
+class upstream_timer:
+    """Context manager that records the latency and in-flight count of one upstream request"""
+
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        UPSTREAM_IN_FLIGHT.labels(self.endpoint).inc()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        UPSTREAM_IN_FLIGHT.labels(self.endpoint).dec()
+        UPSTREAM_LATENCY.labels(self.endpoint).observe(time.perf_counter() - self.started)
+        # cancellation means the caller gave up (e.g. a leg timed out), not that the upstream failed
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            UPSTREAM_ERRORS.labels(self.endpoint, "connection").inc()
+
+
+def record_upstream_status(endpoint: str, status_code: int):
+    if status_code >= 400:
+        UPSTREAM_ERRORS.labels(endpoint, str(status_code)).inc()
+
+
+def record_upstream_rejection(endpoint: str, reason: str):
+    UPSTREAM_REJECTIONS.labels(endpoint, reason).inc()
+
+
+def record_upstream_retry(endpoint: str, outcome: str):
+    UPSTREAM_RETRIES.labels(endpoint, outcome).inc()
+
+
+def record_hedge(endpoint: str, outcome: str):
+    UPSTREAM_HEDGES.labels(endpoint, outcome).inc()
+
+
+def record_circuit_state(upstream: str, state: str):
+    UPSTREAM_CIRCUIT_OPEN.labels(upstream).set(0 if state == "closed" else 1)
+
+
+def record_rate_limited(client: str):
+    RATE_LIMITED.labels(client).inc()
+
+
+def mark_worker_dead(pid: int):
+    """Drop the gauge values of an exited worker, for gunicorn's child_exit hook"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ or "prometheus_multiproc_dir" in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+def latest():
+    """Return the content type and body of a metrics scrape"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ or "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return CONTENT_TYPE_LATEST, generate_latest(registry)
@@ -1,6 +1,8 @@
-from typing import List, Optional
+from typing import List, Optional, Type
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, VERSION
+
+PYDANTIC_V1 = VERSION.startswith("1.")
 
 
 class UniqueId(BaseModel):
@@ -19,12 +21,30 @@ class User(BaseModel):
     orcid: str = Field(description="user's ORCID")
 
 
+class PartialUser(User):
+    """A User some of whose groups are missing, because an upstream they come from failed
+    or timed out. Encodes just as a User does, so that callers can tell only by its type,
+    and caches can keep it for less time than a complete user."""
+
+
 class AccessGroup(BaseModel):
     uid: str = Field(description="group's system unique identifier")
     name: str = Field(description="group's name")
     members: Optional[List[UniqueId]] = Field(None, description="list of users in the access group")
 
 
+def trusted_user(model: Type[User] = User, **fields) -> User:
+    """Build a User, or a subclass of it, from fields that a service has already shaped itself.
+
+    Pydantic 1 validation is pure python, so its validation is skipped with construct().
+    Pydantic 2 validates in compiled code, which is faster than its construct(), so
+    there the fields are validated as usual.
+    """
+    if PYDANTIC_V1:
+        return model.construct(**fields)
+    return model(**fields)
+
+
 class MappedField(BaseModel):
     source: str
     source_name: str
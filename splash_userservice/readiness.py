@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Collection, Dict, Optional
+
+from splash_userservice.service import UserService
+
+logger = logging.getLogger("users.readiness")
+
+# reported in place of the upstreams when probing them raised
+PROBE_FAILED = "service"
+
+
+class UpstreamProbe:
+    """Probes a service's upstreams in the background, so that readiness checks only read
+    the last results and cost nothing however often they are made.
+
+    The service is warm once every required upstream has answered a probe. Until then
+    probes are repeated every ``retry_interval`` seconds, and after that every ``interval``
+    seconds, which also keeps pooled connections from going idle. Upstreams that are not
+    required, and any upstream failing after the service is warm, show in the results but
+    do not hold readiness back: lookups already fail fast on a sick upstream, returning
+    what the other upstreams know, and cached users can still be served. Requiring every
+    upstream would keep all workers out of service while any one of them is down.
+
+    Parameters
+    ----------
+    service : UserService
+        service whose upstreams are probed
+    required : Collection[str]
+        names of the upstreams that must answer before the service is warm, all by default
+    interval : float
+        seconds between probes once warm
+    retry_interval : float
+        seconds between probes until warm
+    clock : Callable[[], float]
+        source of the time of each probe, wall clock seconds by default
+    """
+
+    def __init__(
+            self,
+            service: UserService,
+            required: Collection[str] = None,
+            interval: float = 15.0,
+            retry_interval: float = 1.0,
+            clock: Callable[[], float] = time.time) -> None:
+        self.service = service
+        self.required = required
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._clock = clock
+        self.results: Dict[str, Optional[str]] = {}
+        self.checked: Optional[float] = None
+        self.warm = False
+
+    async def check(self):
+        try:
+            results = await self.service.probe()
+        except Exception as e:
+            logger.exception("error probing upstreams")
+            results = {PROBE_FAILED: repr(e)}
+        self.results = results
+        self.checked = self._clock()
+        if not self.warm and self.answered(results):
+            logger.info("upstreams answered, ready: %s",
+                        ", ".join(name for name, error in results.items() if error is None) or "none")
+            self.warm = True
+        for name, error in results.items():
+            if error is not None:
+                logger.warning("probe of %s failed: %s", name, error)
+
+    def answered(self, results: Dict[str, Optional[str]]) -> bool:
+        """Whether every required upstream that the service has answered its probe"""
+        if PROBE_FAILED in results:
+            return False
+        names = results if self.required is None else [name for name in self.required if name in results]
+        return all(results[name] is None for name in names)
+
+    async def run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval if self.warm else self.retry_interval)
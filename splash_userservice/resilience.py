@@ -0,0 +1,417 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List
+
+from splash_userservice.metrics import record_hedge
+from splash_userservice.service import CommunicationError
+
+logger = logging.getLogger("users.resilience")
+
+
+class CircuitOpen(CommunicationError):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+    pass
+
+
+class BulkheadFull(CommunicationError):
+    """Raised instead of calling an upstream that already has its share of requests in flight"""
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing, and lets a few calls through
+    now and then to find out whether it has recovered.
+
+    The breaker starts closed, letting every call through. After ``failure_threshold``
+    consecutive failures it opens, and calls fail immediately for ``recovery_time``
+    seconds. It then goes half open, letting up to ``half_open_calls`` calls through at
+    once: a success closes it again, a failure opens it for another ``recovery_time``.
+
+    Parameters
+    ----------
+    name : str
+        name of the upstream, for logging and errors
+    failure_threshold : int
+        consecutive failures that open the breaker
+    recovery_time : float
+        seconds the breaker stays open before letting a trial call through
+    half_open_calls : int
+        trial calls allowed at once while half open
+    clock : Callable[[], float]
+        source of the current time in seconds, monotonic by default
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+            self,
+            name: str,
+            failure_threshold: int = 5,
+            recovery_time: float = 30.0,
+            half_open_calls: int = 1,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_calls = half_open_calls
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.recovery_time:
+            self._state = self.HALF_OPEN
+            self._trials = 0
+        return self._state
+
+    def acquire(self):
+        """Call before each call to the upstream, raises CircuitOpen if the call must not be made"""
+        state = self.state
+        if state == self.OPEN:
+            raise CircuitOpen(f"circuit to {self.name} is open")
+        if state == self.HALF_OPEN:
+            if self._trials >= self.half_open_calls:
+                raise CircuitOpen(f"circuit to {self.name} is half open, waiting on a trial call")
+            self._trials += 1
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logger.info("circuit to %s closed", self.name)
+        self._state = self.CLOSED
+        self._failures = 0
+
+    def record_cancelled(self):
+        """Call when a call was abandoned before it succeeded or failed, e.g. on a timeout"""
+        if self._state == self.HALF_OPEN and self._trials > 0:
+            self._trials -= 1
+
+    def record_failure(self):
+        self._failures += 1
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning("circuit to %s opened after %s failures", self.name, self._failures)
+            self._state = self.OPEN
+            self._opened_at = self._clock()
+
+
+class Bulkhead:
+    """Limits the number of calls in flight to an upstream, so that a slow upstream
+    cannot tie up every worker. Calls that cannot start within ``max_wait`` seconds
+    raise BulkheadFull.
+
+    Use as an async context manager around each call.
+    """
+
+    def __init__(self, name: str, max_concurrent: int = 20, max_wait: float = 0.0) -> None:
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self._semaphore = None
+        self.in_flight = 0
+
+    async def __aenter__(self):
+        # created on first use, so that it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        if self._semaphore.locked() and self.max_wait <= 0:
+            raise BulkheadFull(f"{self.max_concurrent} requests to {self.name} already in flight")
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait or None)
+        except asyncio.TimeoutError:
+            raise BulkheadFull(f"{self.max_concurrent} requests to {self.name} already in flight") from None
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+class RetryBudget:
+    """Caps retries at a fraction of live traffic, so that retries cannot multiply
+    the load on an upstream that is already failing.
+
+    Every request deposits ``ratio`` of a token and every retry withdraws a whole one,
+    so over time at most ``ratio`` retries are made per request. ``min_per_second``
+    tokens are added each second regardless of traffic, so that retries remain
+    possible at low request rates. At most ``max_tokens`` can be saved up.
+    """
+
+    def __init__(
+            self,
+            ratio: float = 0.1,
+            min_per_second: float = 1.0,
+            max_tokens: float = 10.0,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._clock = clock
+        self._tokens = max_tokens
+        self._updated = clock()
+
+    def deposit(self):
+        """Call once per request, not per retry"""
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        """Return whether a retry may be made, spending from the budget if so"""
+        now = self._clock()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+
+def backoff_delay(attempt: int, base: float, cap: float, rng: random.Random = random) -> float:
+    """Seconds to wait before retry number ``attempt`` (from 1), with exponential
+    backoff and full jitter, so that clients retrying together spread out"""
+    return rng.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class LatencyTracker:
+    """Recent latencies of a call, for estimating percentiles of its latency
+
+    Keeps the last ``size`` observations. Percentiles are recomputed at most every
+    ``recompute_every`` observations, so reading them is cheap.
+    """
+
+    def __init__(self, size: int = 1000, recompute_every: int = 50) -> None:
+        self._samples = deque(maxlen=size)
+        self._recompute_every = recompute_every
+        self._since_sorted = 0
+        self._sorted: List[float] = []
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        self._since_sorted += 1
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, fraction: float) -> float:
+        if self._since_sorted >= self._recompute_every or (not self._sorted and self._samples):
+            self._sorted = sorted(self._samples)
+            self._since_sorted = 0
+        if not self._sorted:
+            return 0.0
+        return self._sorted[min(len(self._sorted) - 1, int(fraction * len(self._sorted)))]
+
+
+class Hedger:
+    """Sends a second, identical call when the first has not answered within a
+    percentile of recent latencies, and returns whichever answers first.
+
+    The other call is cancelled. Hedging only starts once ``min_samples`` latencies
+    have been seen, the delay is never less than ``min_delay``, and the fraction of
+    calls that are hedged is capped at ``max_rate`` by a budget, so that hedging
+    cannot double the load on a slow upstream.
+
+    Parameters
+    ----------
+    name : str
+        name of the call, for metrics
+    percentile : float
+        fraction of calls that should answer before a hedge is sent, e.g. 0.95
+    min_delay : float
+        seconds to wait before hedging, at least
+    max_rate : float
+        most calls hedged, as a fraction of calls
+    min_samples : int
+        latencies observed before hedging starts
+    """
+
+    def __init__(
+            self,
+            name: str,
+            percentile: float = 0.95,
+            min_delay: float = 0.01,
+            max_rate: float = 0.05,
+            min_samples: int = 20) -> None:
+        self.name = name
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = LatencyTracker()
+        self.budget = RetryBudget(ratio=max_rate, min_per_second=0.0, max_tokens=max(1.0, 100 * max_rate))
+        self.fired = 0
+        self.won = 0
+
+    def delay(self) -> float:
+        return max(self.min_delay, self.latencies.percentile(self.percentile))
+
+    async def run(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        self.budget.deposit()
+        started = {}
+        calls = set()
+
+        def start():
+            future = asyncio.ensure_future(call())
+            started[future] = time.perf_counter()
+            calls.add(future)
+            return future
+
+        primary = start()
+        try:
+            if len(self.latencies) >= self.min_samples:
+                await asyncio.wait(calls, timeout=self.delay())
+                if not primary.done() and self.budget.try_withdraw():
+                    self.fired += 1
+                    record_hedge(self.name, "fired")
+                    start()
+            error = None
+            pending = calls
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is not None:
+                        error = finished.exception()
+                        continue
+                    if finished is not primary:
+                        self.won += 1
+                        record_hedge(self.name, "won")
+                    self.latencies.observe(time.perf_counter() - started[finished])
+                    return finished.result()
+            raise error
+        finally:
+            for future in calls:
+                if not future.done():
+                    future.cancel()
+
+
+class TokenBucket:
+    """Rate limit: allows ``rate`` calls a second on average, and bursts of up to ``burst``
+
+    A rate of 0 allows every call. State is kept in process, so each worker process
+    limits separately.
+    """
+
+    def __init__(self, rate: float, burst: float = None, clock: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Return whether a call may be made now, spending from the bucket if so"""
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def retry_after(self, tokens: float = 1.0) -> float:
+        """Seconds until ``tokens`` will be available"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    async def acquire(self, tokens: float = 1.0):
+        """Wait until a call may be made, then spend from the bucket"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.retry_after(tokens))
+
+
+class FairScheduler:
+    """Shares a limited number of concurrent calls between clients in proportion to their weights
+
+    While there is capacity every call starts at once. When calls have to wait, each free
+    slot goes to the waiting client with the fewest calls in flight for its weight, so a
+    client with weight 4 gets four times the concurrency of a client with weight 1, and no
+    client can starve the others however many calls it queues. Each client's calls start
+    in the order they were made.
+
+    Parameters
+    ----------
+    max_concurrent : int
+        most calls in flight at once, across all clients of this process
+    """
+
+    def __init__(self, max_concurrent: int) -> None:
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self._running: Dict[Hashable, int] = {}
+        self._waiting: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self._weights: Dict[Hashable, float] = {}
+
+    def running(self, client: Hashable) -> int:
+        return self._running.get(client, 0)
+
+    def waiting(self, client: Hashable) -> int:
+        return len(self._waiting.get(client, ()))
+
+    @asynccontextmanager
+    async def slot(self, client: Hashable, weight: float = 1.0):
+        await self.acquire(client, weight)
+        try:
+            yield
+        finally:
+            self.release(client)
+
+    async def acquire(self, client: Hashable, weight: float = 1.0):
+        self._weights[client] = weight
+        if self.in_flight < self.max_concurrent and not self._waiting:
+            self._start(client)
+            return
+        granted = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(client, deque()).append(granted)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                # the slot was granted just as the caller gave up
+                self.release(client)
+            else:
+                self._forget(client, granted)
+            raise
+
+    def release(self, client: Hashable):
+        self.in_flight -= 1
+        running = self._running[client] - 1
+        if running:
+            self._running[client] = running
+        else:
+            del self._running[client]
+        self._dispatch()
+
+    def _start(self, client: Hashable):
+        self.in_flight += 1
+        self._running[client] = self._running.get(client, 0) + 1
+
+    def _forget(self, client: Hashable, granted: asyncio.Future):
+        waiting = self._waiting.get(client)
+        if waiting is not None and granted in waiting:
+            waiting.remove(granted)
+            if not waiting:
+                del self._waiting[client]
+
+    def _dispatch(self):
+        while self.in_flight < self.max_concurrent and self._waiting:
+            client = min(self._waiting, key=lambda waiting: self.running(waiting) / self._weights[waiting])
+            waiting = self._waiting[client]
+            granted = waiting.popleft()
+            if not waiting:
+                del self._waiting[client]
+            if granted.done():
+                continue
+            self._start(client)
+            granted.set_result(None)
@@ -1,6 +1,7 @@
 
 from abc import ABC, abstractmethod
 from enum import Enum
+from typing import Dict, Optional
 
 from splash_userservice.models import (
     User
@@ -12,10 +13,40 @@ class IDType(Enum):
     email = "email"
 
 
+class LookupDepth(Enum):
+    """How much of a user to look up. Deeper lookups cost more upstream calls."""
+    # name, email and institution only
+    profile = "profile"
+    # profile, plus the beamlines the user is staff on as groups
+    beamlines = "beamlines"
+    # profile, plus beamline, proposal and ESAF groups
+    full = "full"
+
+    @classmethod
+    def _missing_(cls, value):
+        # the old name of beamlines, also as it arrives when its + is not escaped in a query
+        if value in ("profile+beamlines", "profile beamlines"):
+            return cls.beamlines
+        return None
+
+
 class UserService(ABC):
 
+    async def startup(self):
+        """Called once when the application starts, e.g. to open upstream connections"""
+        pass
+
+    async def shutdown(self):
+        """Called once when the application stops, to release resources opened in startup"""
+        pass
+
+    async def probe(self) -> Dict[str, Optional[str]]:
+        """Check that the upstreams this service depends on can be reached, opening connections
+        to them ahead of the first lookups. Returns the error for each upstream, None if it answered."""
+        return {}
+
     @abstractmethod
-    async def get_user(self, id: str, id_type: IDType) -> User:
+    async def get_user(self, id: str, id_type: IDType, depth: LookupDepth = LookupDepth.full) -> User:
         raise NotImplementedError()
 
 
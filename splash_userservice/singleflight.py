@@ -0,0 +1,41 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single in-flight call.
+
+    The first caller for a key starts the call; callers arriving while it is still
+    running wait for the same result, or the same exception. Once the call completes
+    the key is forgotten, so the next caller starts a fresh call.
+
+    Waiters are shielded from each other: a caller that is cancelled (e.g. because its
+    client disconnected) does not cancel the call that other callers are waiting on.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, "asyncio.Future"] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(call)
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def is_running(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def _forget(self, key: Hashable, call: "asyncio.Future"):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # mark the exception as retrieved in case every waiter was cancelled
+        if not call.cancelled():
+            call.exception()
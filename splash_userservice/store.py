@@ -0,0 +1,148 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import sqlite3
+import time
+from typing import Callable, Hashable, Optional, Tuple
+
+from splash_userservice.models import User
+
+logger = logging.getLogger("users.store")
+
+# (user, not found message, wall clock expiry, wall clock time it was resolved upstream)
+StoredEntry = Tuple[Optional[User], Optional[str], float, Optional[float]]
+
+
+class SQLiteUserStore:
+    """Cache of users in a SQLite database shared by every worker process on a node
+
+    The database is opened in WAL mode, so that readers in one worker are not blocked
+    by another worker writing. Each process uses its own connection, opened lazily so
+    that it is created after the server has forked its workers. All database calls
+    run on a single background thread so they never block the event loop.
+
+    On /dev/shm the database is shared by the workers but lost when the node restarts.
+    On disk it also survives restarts, and rows are read one key at a time as they are
+    needed, so a large database does not slow startup.
+
+    Expiry times are stored as wall clock times, since monotonic clocks are not
+    comparable between processes.
+
+    Parameters
+    ----------
+    path : str
+        path of the database file, e.g. on /dev/shm to keep it in memory
+    max_size : int
+        number of rows above which the oldest rows are deleted
+    purge_interval : int
+        number of writes between purges of expired rows
+    clock : Callable[[], float]
+        source of wall clock time in seconds
+    """
+
+    def __init__(
+            self,
+            path: str,
+            max_size: int = 100000,
+            purge_interval: int = 1000,
+            clock: Callable[[], float] = time.time) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.purge_interval = purge_interval
+        self._clock = clock
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._writes = 0
+
+    async def open(self):
+        await self._run(self._connect)
+
+    async def close(self):
+        if self._executor is None:
+            return
+        await self._run(self._disconnect)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+    async def get(self, key: Hashable) -> Optional[StoredEntry]:
+        return await self._run(self._get, key_to_str(key))
+
+    async def put(
+            self,
+            key: Hashable,
+            user: Optional[User],
+            not_found: Optional[str],
+            expires: float,
+            resolved: float = None):
+        await self._run(self._put, key_to_str(key), user, not_found, expires, resolved)
+
+    async def _run(self, fn, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-store")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " key TEXT PRIMARY KEY,"
+                " user TEXT,"
+                " not_found TEXT,"
+                " expires REAL NOT NULL,"
+                " resolved REAL)")
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(users)")}
+            if "resolved" not in columns:
+                # created before resolved times were stored
+                connection.execute("ALTER TABLE users ADD COLUMN resolved REAL")
+            connection.execute("CREATE INDEX IF NOT EXISTS users_expires ON users (expires)")
+            self._connection = connection
+        return self._connection
+
+    def _disconnect(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _get(self, key: str) -> Optional[StoredEntry]:
+        row = self._connect().execute(
+            "SELECT user, not_found, expires, resolved FROM users WHERE key = ? AND expires > ?",
+            (key, self._clock())).fetchone()
+        if row is None:
+            return None
+        user, not_found, expires, resolved = row
+        return (load_user(user) if user is not None else None), not_found, expires, resolved
+
+    def _put(self, key: str, user: Optional[User], not_found: Optional[str], expires: float, resolved: float):
+        connection = self._connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO users (key, user, not_found, expires, resolved) VALUES (?, ?, ?, ?, ?)",
+            (key, dump_user(user) if user is not None else None, not_found, expires, resolved))
+        self._writes += 1
+        if self._writes % self.purge_interval == 0:
+            self._purge(connection)
+
+    def _purge(self, connection: sqlite3.Connection):
+        connection.execute("DELETE FROM users WHERE expires <= ?", (self._clock(),))
+        connection.execute(
+            "DELETE FROM users WHERE key IN "
+            "(SELECT key FROM users ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,))
+
+
+def key_to_str(key: Hashable) -> str:
+    return "|".join(part.value if hasattr(part, "value") else str(part) for part in key)
+
+
+def dump_user(user: User) -> str:
+    if hasattr(user, "model_dump"):
+        return json.dumps(user.model_dump())
+    return user.json()
+
+
+def load_user(data: str) -> User:
+    return User(**json.loads(data))
@@ -0,0 +1,22 @@
+import pytest
+
+
+class FakeClock:
+    """Clock for tests, which only moves when ``now`` is set"""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+@pytest.fixture
+def wall_clock() -> FakeClock:
+    """A second clock, for code that reads monotonic and wall clock time apart"""
+    return FakeClock()
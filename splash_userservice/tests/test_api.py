@@ -0,0 +1,277 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+import httpx
+
+from splash_userservice import api
+from splash_userservice.clients import ApiKeys
+from splash_userservice.groups import GroupIndex
+from splash_userservice.models import User
+from splash_userservice.readiness import UpstreamProbe
+from splash_userservice.service import LookupDepth, UserNotFound, UserService
+
+
+class FakeService(UserService):
+    async def get_user(self, id, id_type, depth=LookupDepth.full):
+        if id == "missing":
+            raise UserNotFound(f"user {id} not found")
+        if id == "broken":
+            raise KeyError("OrgEmail")
+        return User(uid=id, orcid=id, groups=["beamline1"] if depth != LookupDepth.profile else None)
+
+
+def request(monkeypatch, method, url, params=None, api_keys=None, **kwargs):
+    monkeypatch.setattr(api, "API_KEY", "secret")
+    # None builds the keys again from API_KEY
+    monkeypatch.setattr(api.this, "api_keys", api_keys)
+    api.app.dependency_overrides[api.get_service] = FakeService
+
+    async def run():
+        async with httpx.AsyncClient(app=api.app, base_url="http://test") as client:
+            return await client.request(method, url, params={"api_key": "secret", **(params or {})}, **kwargs)
+
+    try:
+        return asyncio.run(run())
+    finally:
+        api.app.dependency_overrides.clear()
+
+
+def test_batch_streams_ndjson(monkeypatch):
+    lookups = [{"id": "ford", "id_type": "orcid"},
+               {"id": "missing", "id_type": "email"},
+               {"id": "broken", "id_type": "orcid"},
+               {"id": "arthur", "id_type": "orcid"}]
+    response = request(monkeypatch, "POST", "/api/v1/users:batch", json=lookups)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    results = {line["id"]: line for line in map(json.loads, response.text.splitlines())}
+    assert results["ford"]["user"]["groups"] == ["beamline1"]
+    assert results["arthur"]["id_type"] == "orcid"
+    assert results["missing"]["error"]["status"] == 404
+    # an unexpected error fails its own line, not the stream
+    assert results["broken"]["error"]["status"] == 500
+
+
+def test_group_members(monkeypatch):
+    index = GroupIndex()
+    for uid in ("1", "2", "3"):
+        index.add_user(User(uid=uid, orcid=f"orcid-{uid}", groups=["beamline1"]))
+    api.app.dependency_overrides[api.get_group_index] = lambda: index
+    response = request(monkeypatch, "GET", "/api/v1/groups/beamline1/members", params={"limit": 2})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 3
+    assert [member["id"] for member in body["group"]["members"]] == ["orcid-1", "orcid-2"]
+
+    api.app.dependency_overrides[api.get_group_index] = lambda: index
+    assert request(monkeypatch, "GET", "/api/v1/groups/beamline2/members").status_code == 404
+
+
+def test_metrics(monkeypatch):
+    request(monkeypatch, "POST", "/api/v1/users:batch", json=[{"id": "ford", "id_type": "orcid"}])
+    response = request(monkeypatch, "GET", "/metrics")
+    assert response.status_code == 200
+    assert 'route="/api/v1/users:batch"' in response.text
+    assert "userservice_cache_events_total" in response.text
+
+
+def test_get_user_depth(monkeypatch):
+    response = request(monkeypatch, "GET", "/api/v1/users/ford/orcid", params={"depth": "profile"})
+    assert response.json()["groups"] is None
+    response = request(monkeypatch, "GET", "/api/v1/users/ford/orcid", params={"fetch_groups": "false"})
+    assert response.json()["groups"] is None
+    response = request(monkeypatch, "GET", "/api/v1/users/ford/orcid")
+    assert response.json()["groups"] == ["beamline1"]
+    # sent as typed, and by its old name with the + unescaped, which arrives as a space
+    for depth in ("beamlines", "profile+beamlines"):
+        response = request(monkeypatch, "GET", f"/api/v1/users/ford/orcid?depth={depth}")
+        assert response.status_code == 200
+        assert response.json()["groups"] == ["beamline1"]
+
+
+def test_conditional_get(monkeypatch):
+    response = request(monkeypatch, "GET", "/api/v1/users/ford/orcid")
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"].startswith("private, max-age=")
+
+    response = request(monkeypatch, "GET", "/api/v1/users/ford/orcid", headers={"If-None-Match": f'W/{etag}'})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    response = request(monkeypatch, "GET", "/api/v1/users/arthur/orcid", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_api_keys_with_rate_limits(monkeypatch, tmp_path):
+    keys_file = tmp_path / "keys.json"
+    keys_file.write_text(json.dumps({
+        "scicat": {"key_sha256": hashlib.sha256(b"scicat-key").hexdigest()},
+        "ingest": {"key": "ingest-key", "rate": 1, "burst": 2, "weight": 0.5},
+    }))
+    api_keys = ApiKeys.from_config(str(keys_file), "secret")
+
+    def get(key):
+        return request(monkeypatch, "GET", "/api/v1/users/ford/orcid", params={"api_key": key}, api_keys=api_keys)
+
+    assert get("secret").status_code == 200
+    assert get("scicat-key").status_code == 200
+    assert get("wrong").status_code == 403
+    assert [get("ingest-key").status_code for _ in range(2)] == [200, 200]
+    limited = get("ingest-key")
+    assert limited.status_code == 429
+    assert limited.headers["retry-after"] == "1"
+    # other clients are not held back
+    assert get("scicat-key").status_code == 200
+
+
+def test_readyz_reports_cached_probe_results(monkeypatch):
+    class ProbedService(FakeService):
+        probes = 0
+
+        async def probe(self):
+            self.probes += 1
+            return {"alshub": None, "esaf": "status 503" if self.probes == 1 else None}
+
+    service = ProbedService()
+    probe = UpstreamProbe(service)
+    monkeypatch.setattr(api.this, "probe", probe)
+    assert request(monkeypatch, "GET", "/healthz").status_code == 200
+
+    asyncio.run(probe.check())
+    response = request(monkeypatch, "GET", "/readyz")
+    assert response.status_code == 503
+    assert response.json()["upstreams"] == {"alshub": "ok", "esaf": "status 503"}
+
+    asyncio.run(probe.check())
+    for _ in range(3):
+        response = request(monkeypatch, "GET", "/readyz")
+        assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+    # readiness checks only read the results of the background probes
+    assert service.probes == 2
+
+
+def test_readyz_does_not_wait_for_optional_upstreams(monkeypatch):
+    class ProbedService(FakeService):
+        alshub = "ConnectError"
+
+        async def probe(self):
+            return {"alshub": self.alshub, "esaf": "status 503"}
+
+    service = ProbedService()
+    probe = UpstreamProbe(service, required=api.READY_REQUIRED_UPSTREAMS)
+    monkeypatch.setattr(api.this, "probe", probe)
+
+    asyncio.run(probe.check())
+    assert request(monkeypatch, "GET", "/readyz").status_code == 503
+
+    # ESAF being down holds no worker back, but is reported
+    service.alshub = None
+    asyncio.run(probe.check())
+    response = request(monkeypatch, "GET", "/readyz")
+    assert response.status_code == 200
+    assert response.json()["upstreams"] == {"alshub": "ok", "esaf": "status 503"}
+
+
+def test_get_service_is_built_once(monkeypatch):
+    import alshub.service
+    monkeypatch.setattr(alshub.service, "ALSHubService", FakeService)
+    monkeypatch.setattr(api, "USER_CACHE_SHARED_PATH", "")
+    monkeypatch.setattr(api, "USER_CACHE_PERSIST_PATH", "")
+    monkeypatch.setattr(api.this, "service", None)
+    monkeypatch.setattr(api.this, "group_index", None)
+    service = api.get_service()
+    # an empty cache is falsy, but is still the service
+    assert len(service) == 0
+    assert api.get_service() is service
+
+
+def test_readyz_reports_failed_warm_up(monkeypatch, caplog):
+    async def warm_up():
+        raise ValueError("'uid' is not a valid IDType")
+
+    loop = asyncio.new_event_loop()
+    try:
+        warmup = loop.create_task(warm_up())
+        warmup.add_done_callback(api.log_warmup_failure)
+        loop.run_until_complete(asyncio.wait([warmup]))
+    finally:
+        loop.close()
+    assert "not a valid IDType" in caplog.text
+
+    monkeypatch.setattr(api.this, "warmup", warmup)
+    response = request(monkeypatch, "GET", "/readyz")
+    assert response.status_code == 200
+    assert "not a valid IDType" in response.json()["warmup"]
+
+
+def test_startup_starts_probes_and_serves_one_service(monkeypatch):
+    class Upstream(FakeService):
+        instances = []
+
+        def __init__(self):
+            self.calls = []
+            Upstream.instances.append(self)
+
+        async def startup(self):
+            self.calls.append("startup")
+
+        async def shutdown(self):
+            self.calls.append("shutdown")
+
+        async def probe(self):
+            self.calls.append("probe")
+            return {"alshub": None}
+
+        async def get_user(self, id, id_type, depth=LookupDepth.full):
+            self.calls.append("get_user")
+            return await super().get_user(id, id_type, depth=depth)
+
+    import alshub.service
+    monkeypatch.setattr(alshub.service, "ALSHubService", Upstream)
+    monkeypatch.setattr(api, "USER_CACHE_SHARED_PATH", "")
+    monkeypatch.setattr(api, "USER_CACHE_PERSIST_PATH", "")
+    monkeypatch.setattr(api, "WARMUP_SEED_FILE", "")
+    monkeypatch.setattr(api, "API_KEY", "secret")
+    for name in ("service", "group_index", "api_keys", "probe", "probe_task", "warmup", "log_listener"):
+        monkeypatch.setattr(api.this, name, None)
+
+    async def run():
+        await api.startup()
+        try:
+            await api.this.probe.check()
+            async with httpx.AsyncClient(app=api.app, base_url="http://test") as client:
+                ready = await client.get("/readyz")
+                user = await client.get("/api/v1/users/ford/orcid", params={"api_key": "secret"})
+        finally:
+            await api.shutdown()
+        return ready, user
+
+    users_logger = logging.getLogger("users")
+    handlers, level = list(users_logger.handlers), users_logger.level
+    try:
+        ready, user = asyncio.run(run())
+    finally:
+        # startup sets up logging, put it back as it was
+        users_logger.handlers = handlers
+        users_logger.setLevel(level)
+    assert ready.status_code == 200
+    assert user.status_code == 200
+    # the service started, probed and shut down is the one that served the request
+    [upstream] = Upstream.instances
+    assert upstream.calls[0] == "startup"
+    assert {"probe", "get_user"} <= set(upstream.calls)
+    assert upstream.calls[-1] == "shutdown"
+
+
+def test_exited_workers_are_dropped_from_gauges(monkeypatch, tmp_path):
+    from splash_userservice.metrics import mark_worker_dead
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    for name in ("gauge_livesum_4242.db", "gauge_livemax_4242.db", "counter_4242.db"):
+        (tmp_path / name).write_bytes(b"")
+    mark_worker_dead(4242)
+    # counters of exited workers still count, their live gauges do not
+    assert [path.name for path in tmp_path.iterdir()] == ["counter_4242.db"]
@@ -0,0 +1,293 @@
+import asyncio
+import json
+
+import pytest
+
+from splash_userservice.cache import CachingUserService, cache_key, user_etag
+from splash_userservice.models import PartialUser, User
+from splash_userservice.service import IDType, LookupDepth, UserNotFound, UserService
+from splash_userservice.store import SQLiteUserStore
+
+
+class CountingService(UserService):
+    def __init__(self):
+        self.calls = 0
+
+    async def get_user(self, id, id_type, depth=LookupDepth.full):
+        self.calls += 1
+        if id == "missing":
+            raise UserNotFound(f"user {id} not found")
+        return User(uid=id, orcid=id, groups=["beamline1"] if depth != LookupDepth.profile else None)
+
+
+def test_ttl_and_depth_key(clock):
+    inner = CountingService()
+    cache = CachingUserService(inner, ttl=10, clock=clock)
+
+    async def run():
+        first = await cache.get_user("ford", IDType.orcid)
+        assert await cache.get_user("ford", IDType.orcid) is first
+        assert inner.calls == 1
+        # depth is part of the key
+        assert (await cache.get_user("ford", IDType.orcid, depth=LookupDepth.profile)).groups is None
+        assert inner.calls == 2
+        clock.now = 11
+        await cache.get_user("ford", IDType.orcid)
+        assert inner.calls == 3
+
+    asyncio.run(run())
+    assert cache.hits == 1
+    assert cache.misses == 3
+
+
+def test_lru_eviction():
+    inner = CountingService()
+    cache = CachingUserService(inner, max_size=2)
+
+    async def run():
+        await cache.get_user("a", IDType.orcid)
+        await cache.get_user("b", IDType.orcid)
+        await cache.get_user("a", IDType.orcid)
+        await cache.get_user("c", IDType.orcid)  # evicts b, the least recently used
+        await cache.get_user("a", IDType.orcid)
+        assert inner.calls == 3
+        await cache.get_user("b", IDType.orcid)
+        assert inner.calls == 4
+
+    asyncio.run(run())
+    assert cache.evictions == 2
+
+
+def test_negative_caching(clock):
+    inner = CountingService()
+    cache = CachingUserService(inner, ttl=100, not_found_ttl=5, clock=clock)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(UserNotFound):
+                await cache.get_user("missing", IDType.email)
+        assert inner.calls == 1
+        clock.now = 6
+        with pytest.raises(UserNotFound):
+            await cache.get_user("missing", IDType.email)
+        assert inner.calls == 2
+
+    asyncio.run(run())
+
+
+class SlowService(CountingService):
+    async def get_user(self, id, id_type, depth=LookupDepth.full):
+        await asyncio.sleep(0.01)
+        return await super().get_user(id, id_type, depth)
+
+
+def test_concurrent_lookups_are_coalesced():
+    inner = SlowService()
+    cache = CachingUserService(inner)
+
+    async def run():
+        users = await asyncio.gather(*[cache.get_user("ford", IDType.orcid) for _ in range(20)])
+        assert all(user is users[0] for user in users)
+        results = await asyncio.gather(*[cache.get_user("missing", IDType.orcid) for _ in range(5)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, UserNotFound) for result in results)
+
+    asyncio.run(run())
+    assert inner.calls == 2
+    assert cache.coalesced == 23
+
+
+def test_stale_while_revalidate(clock):
+    inner = SlowService()
+    cache = CachingUserService(inner, ttl=10, stale_grace=5, clock=clock)
+
+    async def run():
+        first = await cache.get_user("ford", IDType.orcid)
+        clock.now = 12
+        # expired but within grace: served immediately, refreshed in the background
+        assert await cache.get_user("ford", IDType.orcid) is first
+        assert inner.calls == 1
+        await asyncio.sleep(0.05)
+        assert inner.calls == 2
+        refreshed = await cache.get_user("ford", IDType.orcid)
+        assert refreshed is not first
+        # past the hard staleness bound: waits for a fresh lookup
+        clock.now = 100
+        await cache.get_user("ford", IDType.orcid)
+        assert inner.calls == 3
+
+    asyncio.run(run())
+    assert cache.stale_served == 1
+
+
+def test_shared_tier_between_caches(tmp_path):
+    inner = CountingService()
+    path = str(tmp_path / "users.sqlite")
+    worker1 = CachingUserService(inner, shared=SQLiteUserStore(path))
+    worker2 = CachingUserService(inner, shared=SQLiteUserStore(path))
+
+    async def run():
+        await worker1.startup()
+        await worker2.startup()
+        user = await worker1.get_user("ford", IDType.orcid)
+        assert await worker2.get_user("ford", IDType.orcid) == user
+        with pytest.raises(UserNotFound):
+            await worker1.get_user("missing", IDType.orcid)
+        with pytest.raises(UserNotFound):
+            await worker2.get_user("missing", IDType.orcid)
+        await worker1.shutdown()
+        await worker2.shutdown()
+
+    asyncio.run(run())
+    assert inner.calls == 2
+    assert worker2.shared_hits == 2
+
+
+def test_persistent_tier_survives_restart(tmp_path, clock, wall_clock):
+    path = str(tmp_path / "users.sqlite")
+    inner = CountingService()
+
+    def worker():
+        return CachingUserService(
+            inner, ttl=10, persistent=SQLiteUserStore(path, clock=wall_clock),
+            persist_max_age=100, clock=clock, wall_clock=wall_clock)
+
+    async def run():
+        before = worker()
+        await before.startup()
+        await before.get_user("ford", IDType.orcid)
+        with pytest.raises(UserNotFound):
+            await before.get_user("missing", IDType.orcid)
+        await before.shutdown()
+        assert inner.calls == 2
+
+        # within ttl of the lookup: served from disk as fresh
+        wall_clock.now = 5
+        after = worker()
+        await after.startup()
+        assert (await after.get_user("ford", IDType.orcid)).uid == "ford"
+        assert inner.calls == 2
+        assert after.persisted_hits == 1
+        # misses are not persisted
+        with pytest.raises(UserNotFound):
+            await after.get_user("missing", IDType.orcid)
+        assert inner.calls == 3
+        await after.shutdown()
+
+        # older than ttl: served from disk at once and refreshed in the background
+        wall_clock.now = 50
+        after = worker()
+        await after.startup()
+        entry = await after.get_entry("ford", IDType.orcid)
+        assert entry.user.uid == "ford"
+        assert after.stale_served == 1
+        await asyncio.sleep(0.05)
+        assert inner.calls == 4
+        assert after.max_age(await after.get_entry("ford", IDType.orcid)) == 10
+        await after.shutdown()
+
+        # past persist_max_age: looked up again
+        wall_clock.now = 200
+        after = worker()
+        await after.startup()
+        await after.get_user("ford", IDType.orcid)
+        assert inner.calls == 5
+        await after.shutdown()
+
+    asyncio.run(run())
+
+
+def test_persistent_tier_keeps_the_stale_bound_by_default(tmp_path, clock, wall_clock):
+    path = str(tmp_path / "users.sqlite")
+    inner = CountingService()
+
+    def worker(stale_grace):
+        return CachingUserService(
+            inner, ttl=10, stale_grace=stale_grace, persistent=SQLiteUserStore(path, clock=wall_clock),
+            clock=clock, wall_clock=wall_clock)
+
+    async def lookup(stale_grace):
+        service = worker(stale_grace)
+        await service.startup()
+        try:
+            await service.get_user("ford", IDType.orcid)
+            # let any background refresh finish
+            await asyncio.sleep(0.05)
+        finally:
+            await service.shutdown()
+        return service
+
+    async def run():
+        await lookup(20)
+        assert inner.calls == 1
+
+        # within ttl + stale_grace: served from disk and refreshed
+        wall_clock.now = 25
+        assert (await lookup(20)).persisted_hits == 1
+        # written again by the refresh
+        assert inner.calls == 2
+
+        # without stale_grace, as stale as that is never served
+        wall_clock.now = 50
+        assert (await lookup(0)).persisted_hits == 0
+        assert inner.calls == 3
+
+    asyncio.run(run())
+
+
+def test_partial_users_are_cached_briefly(tmp_path, clock):
+    class FlakyService(CountingService):
+        async def get_user(self, id, id_type, depth=LookupDepth.full):
+            self.calls += 1
+            if self.calls == 1:
+                return PartialUser(uid=id, orcid=id, groups=[])
+            return User(uid=id, orcid=id, groups=["esaf1"])
+
+    inner = FlakyService()
+    listened = []
+    shared = SQLiteUserStore(str(tmp_path / "shared.sqlite"))
+    cache = CachingUserService(inner, ttl=300, not_found_ttl=10, stale_grace=300, shared=shared, clock=clock)
+    cache.add_listener(lambda user, depth: listened.append(user.groups))
+
+    async def run():
+        await cache.startup()
+        try:
+            partial = await cache.get_entry("ford", IDType.orcid)
+            assert partial.user.groups == []
+            assert cache.max_age(partial) == 10
+            assert await shared.get(cache_key("ford", IDType.orcid, LookupDepth.full)) is None
+            await cache.get_user("ford", IDType.orcid)
+            assert inner.calls == 1
+
+            # expired, and not served stale, so looked up again at once
+            clock.now = 11
+            assert (await cache.get_user("ford", IDType.orcid)).groups == ["esaf1"]
+            assert inner.calls == 2
+        finally:
+            await cache.shutdown()
+
+    asyncio.run(run())
+    assert cache.stale_served == 0
+    # the group index only hears of the complete user
+    assert listened == [["esaf1"]]
+
+
+def test_etag_ignores_group_order():
+    first = User(uid="1", orcid="ford", groups=["a", "b"])
+    assert user_etag(first) == user_etag(User(uid="1", orcid="ford", groups=["b", "a"]))
+    assert user_etag(first) != user_etag(User(uid="1", orcid="ford", groups=["a"]))
+
+
+def test_entry_body_encoded_once():
+    cache = CachingUserService(CountingService())
+
+    async def run():
+        first = await cache.get_entry("ford", IDType.orcid)
+        second = await cache.get_entry("ford", IDType.orcid)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.body is second.body
+    assert json.loads(first.body) == {
+        "uid": "ford", "authenticators": None, "given_name": None, "family_name": None,
+        "current_institution": None, "current_email": None, "groups": ["beamline1"], "orcid": "ford"}
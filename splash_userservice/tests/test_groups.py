@@ -0,0 +1,18 @@
+from splash_userservice.groups import GroupIndex
+from splash_userservice.models import User
+
+
+def test_group_index_tracks_membership_changes():
+    index = GroupIndex()
+    index.add_user(User(uid="1", orcid="ford", groups=["beamline1", "ALS-0001"]))
+    index.add_user(User(uid="2", orcid="arthur", groups=["ALS-0001"]))
+    index.add_user(User(uid="3", orcid="zaphod"))  # looked up without groups
+    assert [member.id for member in index.members("ALS-0001")] == ["ford", "arthur"]
+    assert [member.id for member in index.members("ALS-0001", offset=1, limit=1)] == ["arthur"]
+
+    index.add_user(User(uid="1", orcid="ford", groups=["ALS-0001"]))
+    assert "beamline1" not in index
+    assert index.count("ALS-0001") == 2
+
+    index.remove_user("2")
+    assert [member.id for member in index.members("ALS-0001")] == ["ford"]
@@ -0,0 +1,44 @@
+import io
+import json
+import logging
+
+from splash_userservice.logs import parse_sample_rates, setup_logging
+
+
+def test_json_records_are_written_by_the_listener():
+    stream = io.StringIO()
+    listener = setup_logging("DEBUG", "json", stream=stream, logger_name="users.test_logs")
+    logger = logging.getLogger("users.test_logs.json")
+    try:
+        logger.info("looked up %s", "ford", extra={"upstream": "alshub"})
+        try:
+            raise ValueError("no such user")
+        except ValueError:
+            logger.exception("lookup failed")
+    finally:
+        listener.stop()
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert first["message"] == "looked up ford"
+    assert first["level"] == "INFO"
+    assert first["logger"] == "users.test_logs.json"
+    assert first["upstream"] == "alshub"
+    assert second["message"] == "lookup failed"
+    assert "ValueError: no such user" in second["exception"]
+
+
+def test_high_volume_loggers_are_sampled():
+    stream = io.StringIO()
+    rates = parse_sample_rates("users.test_sampled.noisy=0.25, users.test_sampled.quiet=0")
+    listener = setup_logging("INFO", "text", rates, stream=stream, logger_name="users.test_sampled")
+    try:
+        for number in range(8):
+            logging.getLogger("users.test_sampled.noisy.child").info("noisy %s", number)
+            logging.getLogger("users.test_sampled.quiet").info("quiet %s", number)
+            logging.getLogger("users.test_sampled.other").info("other %s", number)
+        logging.getLogger("users.test_sampled.quiet").warning("quiet warning")
+    finally:
+        listener.stop()
+    lines = stream.getvalue().splitlines()
+    assert [line.rsplit(" - ", 1)[1] for line in lines if "noisy" in line] == ["noisy 0", "noisy 4"]
+    assert sum("other" in line for line in lines) == 8
+    assert [line.rsplit(" - ", 1)[1] for line in lines if "quiet" in line] == ["quiet warning"]
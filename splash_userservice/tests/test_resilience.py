@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+
+from splash_userservice.resilience import (
+    Bulkhead,
+    BulkheadFull,
+    CircuitBreaker,
+    CircuitOpen,
+    FairScheduler,
+    Hedger,
+    RetryBudget,
+    TokenBucket,
+    backoff_delay
+)
+
+
+def test_circuit_breaker_opens_and_recovers(clock):
+    breaker = CircuitBreaker("esaf", failure_threshold=2, recovery_time=10, clock=clock)
+    for _ in range(2):
+        breaker.acquire()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.acquire()
+
+    clock.now = 11
+    breaker.acquire()  # the trial call
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.acquire()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now = 22
+    breaker.acquire()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.acquire()
+
+
+def test_bulkhead_rejects_when_full():
+    bulkhead = Bulkhead("esaf", max_concurrent=2, max_wait=0.01)
+
+    async def call():
+        async with bulkhead:
+            await asyncio.sleep(0.05)
+
+    async def run():
+        return await asyncio.gather(*[call() for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert [isinstance(result, BulkheadFull) for result in results] == [False, False, True]
+    assert bulkhead.in_flight == 0
+
+
+def test_retry_budget_caps_retries_to_fraction_of_requests(clock):
+    budget = RetryBudget(ratio=0.25, min_per_second=0, max_tokens=1, clock=clock)
+    assert budget.try_withdraw()
+    assert not budget.try_withdraw()
+    for _ in range(4):
+        budget.deposit()
+    assert budget.try_withdraw()
+    assert not budget.try_withdraw()
+
+
+def test_backoff_delay_is_capped():
+    delays = [backoff_delay(attempt, base=0.1, cap=0.3) for attempt in range(1, 10) for _ in range(20)]
+    assert all(0 <= delay <= 0.3 for delay in delays)
+
+
+def test_hedger_returns_first_answer_and_cancels_the_other():
+    hedger = Hedger("ALSGetPerson", min_delay=0.01, max_rate=1.0, min_samples=0)
+    calls = []
+    cancelled = []
+
+    async def call():
+        number = len(calls)
+        calls.append(number)
+        try:
+            # the first call is stuck, the hedge answers quickly
+            await asyncio.sleep(1 if number == 0 else 0.001)
+        except asyncio.CancelledError:
+            cancelled.append(number)
+            raise
+        return number
+
+    async def run():
+        result = await hedger.run(call)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == 1
+    assert cancelled == [0]
+    assert (hedger.fired, hedger.won) == (1, 1)
+
+
+def test_hedger_does_not_hedge_fast_calls():
+    hedger = Hedger("ALSGetPerson", min_delay=0.05, max_rate=1.0, min_samples=0)
+
+    async def call():
+        return "answer"
+
+    assert asyncio.run(hedger.run(call)) == "answer"
+    assert hedger.fired == 0
+
+
+def test_token_bucket_allows_bursts_then_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.retry_after() == pytest.approx(0.5)
+    clock.now = 0.5
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert TokenBucket(rate=0).try_acquire()
+
+
+def test_fair_scheduler_shares_slots_by_weight():
+    async def run():
+        scheduler = FairScheduler(max_concurrent=4)
+
+        async def call(client, weight, done):
+            async with scheduler.slot(client, weight):
+                await done.wait()
+
+        def start(client, weight):
+            done = asyncio.Event()
+            return done, asyncio.ensure_future(call(client, weight, done))
+
+        # the bulk client takes every slot and queues many more calls
+        bulk = [start("bulk", 1) for _ in range(20)]
+        await asyncio.sleep(0)
+        assert scheduler.running("bulk") == 4
+        interactive = [start("interactive", 3) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        # as slots free up they go to the interactive client until it has its share
+        for done, _ in bulk[:3]:
+            done.set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert scheduler.running("interactive") == 3
+        assert scheduler.running("bulk") == 1
+        assert scheduler.waiting("bulk") == 16
+
+        # a queued call that gives up does not hold a place
+        bulk[-1][1].cancel()
+        await asyncio.sleep(0)
+        assert scheduler.waiting("bulk") == 15
+
+        for done, _ in bulk + interactive:
+            done.set()
+        await asyncio.gather(*[task for _, task in bulk[:-1] + interactive])
+        assert scheduler.in_flight == 0
+
+    asyncio.run(run())
@@ -0,0 +1,81 @@
+import asyncio
+import fcntl
+import time
+
+from splash_userservice.cache import CachingUserService
+from splash_userservice.models import User
+from splash_userservice.service import IDType, LookupDepth, UserNotFound, UserService
+from splash_userservice.warmup import read_seed_file, warm_up, warm_up_from_file
+
+
+class FakeService(UserService):
+    def __init__(self):
+        self.looked_up = []
+
+    async def get_user(self, id, id_type, depth=LookupDepth.full):
+        self.looked_up.append((id, id_type))
+        if id == "missing@example.com":
+            raise UserNotFound(id)
+        return User(uid=id, orcid=id)
+
+
+def test_warm_up_from_seed_file(tmp_path):
+    seed_file = tmp_path / "seeds.txt"
+    seed_file.write_text("# hot users\n"
+                         "0000-0002-3580-328X\n"
+                         "\n"
+                         "missing@example.com\n"
+                         "ford@example.com orcid\n")
+    identities = read_seed_file(str(seed_file))
+    assert identities == [("0000-0002-3580-328X", IDType.orcid),
+                          ("missing@example.com", IDType.email),
+                          ("ford@example.com", IDType.orcid)]
+
+    service = FakeService()
+    result = asyncio.run(warm_up(service, identities, rate=1000, concurrency=2))
+    assert sorted(service.looked_up) == sorted(identities)
+    assert (result.found, result.not_found, result.failed) == (2, 1, 0)
+
+
+def test_cached_users_are_not_paced():
+    service = FakeService()
+    cache = CachingUserService(service)
+    identities = [(f"0000-0000-0000-{number:04d}", IDType.orcid) for number in range(5)]
+
+    async def run():
+        for id, id_type in identities:
+            await cache.get_user(id, id_type)
+        started = time.monotonic()
+        # at one lookup a second, these would take four seconds if they were paced
+        result = await warm_up(cache, identities, rate=1)
+        return result, time.monotonic() - started
+
+    result, seconds = asyncio.run(run())
+    assert result.found == 5
+    assert seconds < 1
+    assert len(service.looked_up) == 5
+
+
+def test_workers_wait_for_the_lock_holder(tmp_path):
+    seed_file = tmp_path / "seeds.txt"
+    seed_file.write_text("0000-0002-3580-328X\nford@example.com\n")
+    lock_file = str(tmp_path / "warmup.lock")
+    service = FakeService()
+
+    async def run():
+        with open(lock_file, "a") as holder:
+            # another worker is warming up
+            fcntl.flock(holder, fcntl.LOCK_EX)
+            waiting = asyncio.ensure_future(warm_up_from_file(service, str(seed_file), lock_file=lock_file))
+            await asyncio.sleep(0.05)
+            assert not waiting.done()
+            fcntl.flock(holder, fcntl.LOCK_UN)
+        return await waiting
+
+    result = asyncio.run(run())
+    # the seeds were not replayed
+    assert result.total == 0
+    assert service.looked_up == []
+    # with the lock free, the next worker warms up itself
+    result = asyncio.run(warm_up_from_file(service, str(seed_file), rate=1000, lock_file=lock_file))
+    assert result.found == 2
@@ -0,0 +1,165 @@
+"""Warm the user cache by resolving a seed list of identities
+
+Runs at application startup when WARMUP_SEED_FILE is set, and can be run on its
+own to fill the cache shared by the workers on a node::
+
+    python -m splash_userservice.warmup seeds.txt --rate 20 --concurrency 4
+
+The seed file holds one identity per line, either an ORCID or an email, optionally
+followed by its id type (``orcid`` or ``email``). Blank lines and lines starting
+with ``#`` are ignored.
+"""
+import argparse
+import asyncio
+import fcntl
+import logging
+import time
+from typing import Iterable, List, Tuple
+
+from splash_userservice.cache import CachingUserService
+from splash_userservice.service import IDType, LookupDepth, UserService, UserNotFound
+
+logger = logging.getLogger("users.warmup")
+
+
+class WarmupResult:
+    def __init__(self) -> None:
+        self.found = 0
+        self.not_found = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    @property
+    def total(self) -> int:
+        return self.found + self.not_found + self.failed
+
+    def __repr__(self) -> str:
+        return (f"WarmupResult(found={self.found}, not_found={self.not_found}, "
+                f"failed={self.failed}, seconds={self.seconds:.1f})")
+
+
+def read_seed_file(path: str) -> List[Tuple[str, IDType]]:
+    identities = []
+    with open(path) as seed_file:
+        for line in seed_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) > 1:
+                identities.append((parts[0], IDType(parts[1])))
+            else:
+                identities.append((parts[0], IDType.email if "@" in parts[0] else IDType.orcid))
+    return identities
+
+
+async def warm_up(
+        service: UserService,
+        identities: Iterable[Tuple[str, IDType]],
+        rate: float = 10.0,
+        concurrency: int = 4,
+        depth: LookupDepth = LookupDepth.full) -> WarmupResult:
+    """Resolve each identity through service, starting at most ``rate`` lookups a second
+    with at most ``concurrency`` in flight, so that warming up cannot flood the upstream.
+    Identities a CachingUserService already holds, in process or in its shared tier, are
+    counted as found without being paced, as they do not go upstream."""
+    result = WarmupResult()
+    semaphore = asyncio.Semaphore(concurrency)
+    interval = 1.0 / rate if rate > 0 else 0.0
+    started = time.monotonic()
+
+    async def resolve(id: str, id_type: IDType):
+        try:
+            user = await service.get_user(id, id_type, depth=depth)
+        except UserNotFound:
+            result.not_found += 1
+        except Exception as e:
+            logger.warning("error warming up %s: %r", id, e)
+            result.failed += 1
+        else:
+            if user is None:
+                result.failed += 1
+            else:
+                result.found += 1
+        finally:
+            semaphore.release()
+
+    tasks = []
+    count = 0
+    for id, id_type in identities:
+        if isinstance(service, CachingUserService):
+            entry = await service.get_cached(id, id_type, depth)
+            if entry is not None:
+                if entry.user is not None:
+                    result.found += 1
+                else:
+                    result.not_found += 1
+                continue
+        delay = started + count * interval - time.monotonic()
+        count += 1
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await semaphore.acquire()
+        tasks.append(asyncio.ensure_future(resolve(id, id_type)))
+    await asyncio.gather(*tasks)
+    result.seconds = time.monotonic() - started
+    logger.info("cache warm up finished: %s", result)
+    return result
+
+
+async def warm_up_from_file(
+        service: UserService,
+        seed_file: str,
+        rate: float = 10.0,
+        concurrency: int = 4,
+        lock_file: str = None) -> WarmupResult:
+    """Warm up from a seed file. If lock_file is given, with a cache shared between the
+    processes sharing it, the first process to take the lock warms the shared cache, and
+    any that find it taken wait for that warm up to finish and then return without
+    replaying the seeds, so every worker is ready about as soon as the first one is."""
+    identities = read_seed_file(seed_file)
+    if lock_file is None:
+        logger.info("warming up cache with %s users from %s", len(identities), seed_file)
+        return await warm_up(service, identities, rate, concurrency)
+    with open(lock_file, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("waiting for another worker to warm up the shared cache from %s", seed_file)
+            result = WarmupResult()
+            started = time.monotonic()
+            await asyncio.get_running_loop().run_in_executor(None, fcntl.flock, lock, fcntl.LOCK_EX)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            result.seconds = time.monotonic() - started
+            return result
+        logger.info("warming up cache with %s users from %s", len(identities), seed_file)
+        try:
+            return await warm_up(service, identities, rate, concurrency)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Warm the user cache from a seed file of ORCIDs and emails")
+    parser.add_argument("seed_file", help="file with one ORCID or email per line")
+    parser.add_argument("--rate", type=float, default=10.0, help="most lookups started per second")
+    parser.add_argument("--concurrency", type=int, default=4, help="most lookups in flight at once")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from splash_userservice.api import get_service
+
+    async def run():
+        service = get_service()
+        await service.startup()
+        try:
+            return await warm_up_from_file(service, args.seed_file, args.rate, args.concurrency)
+        finally:
+            await service.shutdown()
+
+    result = asyncio.run(run())
+    print(result)
+
+
+if __name__ == "__main__":
+    main()